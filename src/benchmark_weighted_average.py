@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Example: python3 benchmark_weighted_average.py --mesh_file=local_data/malha/ferrovias.shp --indicator_file=local_data/indicadores/indicator.shp --repeat=3
+
+# Data manipulation and geospatial libraries
+import geopandas as gpd
+from pyproj import CRS
+
+# Numerical processing library
+import numpy as np
+
+# System utility libraries
+import argparse
+import time
+
+# My utility functions
+from utilities import find_indicator_column, grouped_weighted_average, load_shapefile, pairwise_intersection_area
+from mesh_join import MeshJoin
+import config
+
+# Ignore warnings
+import warnings
+warnings.filterwarnings("ignore")
+
+
+def lambda_weighted_average(intersection, key):
+    """Previous merge_shapefiles_mesh.py implementation: a Python lambda and Python sums per group."""
+    return intersection.groupby(key).apply(lambda x: sum(x['CL_ORIG'] * x['weight']) / sum(x['weight']))
+
+
+def grouped_sums_weighted_average(intersection, key):
+    return grouped_weighted_average(intersection[key], intersection['CL_ORIG'], intersection['weight'])
+
+
+MODES = {'lambda': lambda_weighted_average, 'grouped': grouped_sums_weighted_average}
+
+
+def main(args):
+    modes = args.modes.split(',')
+
+    # Same inputs as merge_shapefiles_mesh.py --average
+    mesh = load_shapefile(args.mesh_file, change_crs=True, epsg=config.DEFAULT_CRS, set_buffer=True)
+    mesh = mesh.rename(columns={args.mesh_file_pk: 'mesh_file_pk'}).drop(columns='CL_ORIG', errors='ignore')
+    indicator = gpd.read_file(args.indicator_file)
+    col_name = find_indicator_column(['CL_ORIG', 'CL_N-0ORIG', 'N_ORIG'], indicator)
+    if col_name is None:
+        raise ValueError(f"Indicator column not found in {args.indicator_file}")
+    indicator = indicator.rename(columns={col_name: 'CL_ORIG'}).to_crs(CRS.from_epsg(config.DEFAULT_CRS))
+
+    intersection = MeshJoin(mesh).join(indicator)
+    print("Number of items in the mesh: ", len(mesh))
+    print("Number of intersecting pairs: ", len(intersection))
+    if args.overlap_weighted:
+        start = time.perf_counter()
+        intersection['weight'] = pairwise_intersection_area(
+            intersection.geometry.values, indicator.geometry.loc[intersection['index_right']].values)
+        print(f"Overlap areas of all pairs: {time.perf_counter() - start:.3f} seconds")
+    else:
+        intersection['weight'] = intersection.geometry.area
+
+    timings, results = {}, {}
+    for mode in modes:
+        elapsed = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[mode] = MODES[mode](intersection, 'mesh_file_pk')
+            elapsed.append(time.perf_counter() - start)
+        timings[mode] = min(elapsed)
+
+    reference = modes[0]
+    print(f"\n{'mode':<10} {'seconds':>10} {'speedup':>8} {'max diff':>10} {'nan diff':>9}")
+    for mode in modes:
+        values = results[mode].reindex(results[reference].index).to_numpy(dtype=np.float64)
+        reference_values = results[reference].to_numpy(dtype=np.float64)
+        diff = np.abs(values - reference_values)
+        nan_diff = int((np.isnan(values) != np.isnan(reference_values)).sum())
+        print(f"{mode:<10} {timings[mode]:>10.3f} {timings[reference] / timings[mode]:>8.1f} "
+              f"{np.nanmax(diff, initial=0.0):>10.2e} {nan_diff:>9}")
+    print(f"\nmax diff: largest absolute difference to '{reference}'; nan diff: segments NaN in only one of them")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--mesh_file", required=True,
+                        help="Path to the mesh file. Example: mesh.shp")
+
+    parser.add_argument("--mesh_file_pk", default='objectid',
+                        help="Primary key field name of mesh file.")
+
+    parser.add_argument("--indicator_file", required=True,
+                        help="Path to the indicator shapefile. Example: indicator.shp")
+
+    parser.add_argument("--modes", default='lambda,grouped',
+                        help="Comma separated modes to compare: lambda (Python lambda per mesh segment, previous behaviour) and grouped (columnar grouped sums). The first one is the reference.")
+
+    parser.add_argument("--overlap_weighted", action='store_true',
+                        help="Weight by the overlap area of each pair, as merge_shapefiles_mesh.py --overlap_weighted, and time its computation.")
+
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of runs of each mode. The best time is reported.")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Example: python3 benchmark_zonal_statistics.py --indicator_file=local_data/rasters/indicator.tif --mesh_file=local_data/malha/ferrovias.shp --modes=opencv,label,coverage,numba --repeat=3
+
+# Geospatial data processing libraries
+import rasterio as rio
+
+# Numerical processing library
+import numpy as np
+
+# System utility libraries
+import argparse
+import time
+
+# My utility functions
+from utilities import load_shapefile
+from zonal_statistics import ENGINES, label_zonal_statistics, zonal_statistics
+
+# Ignore warnings
+import warnings
+warnings.filterwarnings("ignore")
+
+
+def run_mode(mode, indicator, geometries):
+    if mode == 'coverage':
+        return label_zonal_statistics(indicator, geometries, coverage_weighted=True)
+    if mode in ENGINES:
+        return zonal_statistics(indicator, geometries, mode)
+    raise ValueError(f"Unknown mode: {mode}")
+
+
+def main(args):
+    modes = args.modes.split(',')
+
+    mesh = load_shapefile(args.mesh_file)
+    print("Number of items in the mesh: ", len(mesh))
+
+    with rio.open(args.indicator_file) as indicator:
+        print("Indicator shape: ", indicator.shape)
+        geometries = mesh.to_crs(indicator.crs).geometry.values
+
+        timings, results = {}, {}
+        for mode in modes:
+            elapsed = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results[mode] = run_mode(mode, indicator, geometries)
+                elapsed.append(time.perf_counter() - start)
+            timings[mode] = min(elapsed)
+
+    reference = modes[0]
+    print(f"\n{'mode':<10} {'seconds':>10} {'speedup':>8} {'empty':>7} {'mean diff':>10} {'max diff':>10}")
+    for mode in modes:
+        mean, max_value = results[mode][(1, 'mean')], results[mode][(1, 'max')]
+        mean_diff = np.abs(mean - results[reference][(1, 'mean')])
+        max_diff = np.abs(max_value - results[reference][(1, 'max')])
+        print(f"{mode:<10} {timings[mode]:>10.3f} {timings[reference] / timings[mode]:>8.1f} "
+              f"{int((mean == -1.0).sum()):>7} {mean_diff.mean():>10.4f} {max_diff.mean():>10.4f}")
+    print(f"\nempty: polygons left with the -1.0 sentinel; diffs are the average absolute difference to '{reference}'")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--indicator_file", required=True,
+                        help="Path to the indicator raster. Example: indicator.tif")
+
+    parser.add_argument("--mesh_file", required=True,
+                        help="Path to the mesh file. Example: mesh.shp")
+
+    parser.add_argument("--modes", default='opencv,label,coverage',
+                        help="Comma separated modes to compare: opencv (mask per polygon), label (label raster), coverage (coverage-fraction weighted) and numba (JIT scanline rasterizer). The first one is the reference.")
+
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of runs of each mode. The best time is reported.")
+
+    args = parser.parse_args()
+    main(args)
@@ -1 +1,6 @@
-DEFAULT_CRS=5880
\ No newline at end of file
+DEFAULT_CRS=5880
+
+# Canonical analysis grid (merge_rasters_mesh.py --canonical_resolution): pixel size, in units of
+# DEFAULT_CRS, and (left, bottom, right, top) bounds. None bounds cover the mesh.
+CANONICAL_RESOLUTION=None
+CANONICAL_GRID_BOUNDS=None
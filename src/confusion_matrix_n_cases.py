@@ -11,6 +11,7 @@ import time
 
 # My functions utilities
 from utilities import *
+from mesh_join import MeshJoin
 import config
 
 
@@ -44,6 +45,9 @@ def main(args):
     if 'objectid' not in mesh.columns:
         mesh.columns = ['objectid', *mesh.columns[1:]]
 
+    # Spatial index of the mesh, built once and queried with every indicator
+    mesh_join = MeshJoin(mesh)
+
     # Get all indicators shapefiles paths
     all_indicator_shapefile_paths = glob.glob(
         indicator_files_mask, recursive=True)
@@ -104,12 +108,15 @@ def main(args):
         if debug:
             print("New CRS of the indicator:", indicator.crs)
 
-        # First merge indicator with the mesh, obtaining the geometries.
-        mesh_merge = mesh.merge(indicator_df, on='objectid', how='inner')
+        # First find the mesh segments intersecting each indicator polygon.
+        mesh_indices, indicator_indices = mesh_join.pairs(indicator.geometry.values)
+        pairs = pd.DataFrame({'objectid': mesh['objectid'].values[mesh_indices],
+                              'indicator_index': indicator_indices})
 
-        # Then merge indicator+mesh with the original indicator value.
-        intersection = gpd.sjoin(
-            indicator, mesh_merge, how='inner', predicate='intersects')
+        # Then merge each pair with the estimated value of its mesh segment.
+        pairs = pairs.merge(indicator_df, on='objectid', how='inner')
+        intersection = indicator.iloc[pairs['indicator_index'].values].copy()
+        intersection['values'] = pairs['values'].values
 
         # Routine to generate the confusion matrix.
         CONFUSION_BINS = [0, 0.01, 0.25, 0.50, 0.75, 1]
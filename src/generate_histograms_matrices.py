@@ -39,6 +39,7 @@ from utilities import (
     generate_histogram,
     load_shapefile,
 )
+from mesh_join import MeshJoin
 
 def main(args):
     mesh_file_path = args.mesh_file
@@ -73,6 +74,8 @@ def main(args):
 
     indicator_files = glob(indicator_files_mask, recursive=True)
     mesh_indicators = load_shapefile(mesh_file_path, debug=debug, change_crs=True, epsg=config.DEFAULT_CRS, set_buffer=False)
+    # Spatial index of the mesh, built once and queried with every indicator
+    mesh_join = MeshJoin(mesh_indicators)
 
     indicators_relation = pd.read_excel(indicators_spreadsheet)
     if debug:
@@ -121,7 +124,7 @@ def main(args):
             if indicator_column is None:
                 indicator_column = 'ERROR: Indicator column not found!'
 
-            intersection = gpd.sjoin(mesh_indicators, indicator, how='inner', op='intersects')
+            intersection = mesh_join.join(indicator)
 
             CONFUSION_BINS = [0, 0.01, 0.25, 0.50, 0.75, 1]
             CONFUSION_LABELS = ['0.00 to 0.01', '0.01 to 0.25', '0.25 to 0.50', '0.50 to 0.75', '0.75 to 1']
@@ -4,11 +4,10 @@
 
 # Geospatial data processing libraries
 import rasterio as rio
-from pyproj import CRS
+from rasterio.enums import ColorInterp
 
 # Numerical processing library
 import numpy as np
-import cv2
 
 # Data manipulation libraries
 import pandas as pd
@@ -20,12 +19,18 @@ from datetime import datetime
 import argparse
 import time
 import traceback
-
-# Useful libraries
-from progress.bar import Bar
+import re
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
 
 # My utility functions
-from utilities import create_folder_if_not_exists, load_shapefile, convert_multi_to_single_polygon
+from utilities import build_mosaic_vrt, create_folder_if_not_exists, load_shapefile
+from zonal_statistics import (ENGINES, SCANLINE_STATISTICS, MembershipCache, ProjectedMeshCache, geometries_hash,
+                              label_zonal_statistics, line_zonal_statistics, njit, overview_levels,
+                              overview_zonal_statistics, parse_statistics, point_zonal_statistics, spatial_tiles,
+                              tile_window, window_polygons, zonal_statistics)
+from raster_cache import (BlockHashStore, CachedSource, RasterCache, SharedRaster, SharedRasterInfo,
+                          SharedRasterPool, WindowedRaster, block_hashes, canonical_grid, changed_block_windows)
 import config
 
 # Ignore warnings
@@ -41,6 +46,15 @@ def main(args):
     is_average = args.average
     debug = args.debug
     output_folder_path = args.output_folder
+    engine = args.engine
+    all_touched = args.all_touched
+    memory_budget = args.memory_budget
+    cache_dir = args.cache_dir
+    workers = args.workers
+    coverage_weighted = args.coverage_weighted
+    statistics = requested_statistics(args)
+    bands = args.bands
+    overview_tolerance = args.overview_tolerance
 
     if debug:
         print("\nPassed arguments:")
@@ -51,6 +65,22 @@ def main(args):
         print("Average:", is_average, "\n")
         print("Debug:", debug, "\n")
         print("Output folder:", output_folder_path, "\n")
+        print("Engine:", engine, "\n")
+        print("All touched:", all_touched, "\n")
+        print("Memory budget (MB):", memory_budget, "\n")
+        print("Cache folder:", cache_dir, "\n")
+        print("Workers:", workers, "\n")
+        print("Coverage weighted:", coverage_weighted, "\n")
+        print("Statistics:", statistics, "\n")
+        print("Bands:", bands, "\n")
+        print("Overview tolerance:", overview_tolerance, "\n")
+        print("Raster cache folder:", args.raster_cache_dir, "\n")
+        print("Canonical resolution:", args.canonical_resolution, "\n")
+        print("Mosaic group pattern:", args.mosaic_group_pattern, "\n")
+        print("Class histograms legend:", args.class_histograms, "\n")
+        print("Tile size:", args.tile_size, "\n")
+        print("Shared memory:", args.shared_memory, "\n")
+        print("Incremental:", args.incremental, "\n")
         # Default CRS
         print("Default CRS:", config.DEFAULT_CRS, "\n")
 
@@ -60,21 +90,52 @@ def main(args):
     # Concatenate the output/ with the output file name
     updated_mesh_file_path = os.path.join(output_folder_path, updated_mesh_file_path)
     column_relation_file_name = os.path.join(output_folder_path, column_relation_file_name)
+    class_fractions_file_name = os.path.splitext(updated_mesh_file_path)[0] + '_classes.csv'
 
     mesh = load_shapefile(mesh_file_path, debug=debug, change_crs=True, epsg=config.DEFAULT_CRS, set_buffer=False)
     print("Number of items in the mesh: ", len(mesh), "\n")
 
-    # Get next column ID
-    next_col_id = 1
-    if 'I_1' in mesh.columns:
-        last_col = mesh.columns[len(mesh.columns) - 2]
-        next_col_id = int(last_col[2:]) + 1
+    mesh_type = detect_mesh_type(mesh) if args.mesh_type == 'auto' else args.mesh_type
+    print("Mesh type: ", mesh_type, "\n")
+    if mesh_type in ('line', 'point') and args.engine != 'label':
+        raise ValueError(f"{mesh_type.capitalize()} meshes are sampled natively and cannot use the {args.engine} engine")
+    if mesh_type in ('line', 'point') and args.class_histograms is not None:
+        raise ValueError("Class histograms are computed only for polygon meshes")
+
+    # Rasters sharing a grid reuse the polygon membership of the first one. When streaming, only the
+    # on-disk cache is kept, so that the whole membership is never held in memory.
+    mesh_hash = geometries_hash(mesh.geometry.values)
+    membership_cache = MembershipCache(mesh_hash, cache_dir, keep_in_memory=memory_budget is None)
+    # The mesh is projected once per raster CRS; the columns are added to the mesh in the default CRS
+    mesh_cache = ProjectedMeshCache(mesh.geometry, mesh_hash, cache_dir)
+
+    # With a canonical grid every raster is warped once onto it, in the default CRS, and cached; all the
+    # rasters then share a single mesh projection and polygon membership
+    raster_cache = None
+    if args.raster_cache_dir is not None:
+        grid = None
+        if args.canonical_resolution is not None:
+            grid_bounds = config.CANONICAL_GRID_BOUNDS or tuple(mesh.total_bounds)
+            grid = canonical_grid(grid_bounds, args.canonical_resolution, config.DEFAULT_CRS)
+            print(f"Canonical grid: {grid.width} x {grid.height} pixels of {args.canonical_resolution}\n")
+        raster_cache = RasterCache(args.raster_cache_dir, grid)
+
+    # Spatial tiles of the mesh. Every (raster, tile) pair is a separate task reading only the window
+    # around the tile, so the workers also split a single large raster
+    tiles = spatial_tiles(mesh.geometry.values, args.tile_size) if args.tile_size is not None else [None]
+    if args.tile_size is not None:
+        print("Number of tiles: ", len(tiles), "\n")
+
+    # Get next column ID: new columns continue after the largest I_n column of a previous merge
+    indicator_col_ids = [int(match.group(1)) for match in map(re.compile(r'I_(\d+)').fullmatch, mesh.columns)
+                         if match]
+    next_col_id = max(indicator_col_ids) + 1 if indicator_col_ids else 0
 
     if debug:
         print("Next column ID: ", next_col_id)
 
     # Verify if the columns relation file exists.
-    if next_col_id > 1:
+    if indicator_col_ids and os.path.exists(column_relation_file_name):
         print("Columns relation file exists. Opening...")
         # Load the columns relation file
         df_column_relation = pd.read_excel(column_relation_file_name)
@@ -83,146 +144,540 @@ def main(args):
         # Create the columns relation file
         column_relation_data = {
             'file_name': [],
-            'column': []
+            'column': [],
+            'statistic': [],
+            'band': []
         }
         df_column_relation = pd.DataFrame(column_relation_data)
 
     if debug:
         print("Columns relation file head:  ", df_column_relation.head())
 
+    # Share of each legend class in each polygon, one row per polygon, indicator and band
+    legend = read_legend_classes(args.class_histograms) if args.class_histograms is not None else None
+    if legend is not None and indicator_col_ids and os.path.exists(class_fractions_file_name):
+        df_class_fractions = pd.read_csv(class_fractions_file_name)
+    else:
+        df_class_fractions = pd.DataFrame()
+
     indicator_tifs = glob.glob(indicator_files_mask, recursive=True)
 
     print("Number of indicator files found: ", len(indicator_tifs))
 
-    # Print the names of the .tif files found
-    for i, indicator_file_path in enumerate(indicator_tifs):
-        try:
-            # Get the file name without extension
-            file_name_only = os.path.basename(indicator_file_path).split('.')[0]
-
-            print(
-                f"\nStarting the processing of file {next_col_id + i}: {indicator_file_path} {datetime.now()}")
-
-            indicator = rio.open(indicator_file_path)
-            pixel_values = indicator.read(1)
-
-            crs_integer_indicator = int(indicator.crs.to_epsg())
+    # Tiles of the same indicator are merged as one virtual mosaic
+    indicators = group_indicator_files(indicator_tifs, args.mosaic_group_pattern)
+    if args.mosaic_group_pattern is not None:
+        print("Number of indicators after grouping the tiles: ", len(indicators))
+    if raster_cache is not None:
+        # Each raster is hashed once here, not again by each of its tile tasks
+        indicators = [(name, raster_cache.source(source) if isinstance(source, str) else source)
+                      for name, source in indicators]
+    indicator_sources = [source for _, source in indicators]
+
+    # Tiles computed for each indicator. In incremental mode an indicator already in the columns
+    # relation file is recomputed only for the polygons touching the blocks changed since its last
+    # merge, and its columns are patched in place
+    indicator_tiles = [tiles] * len(indicators)
+    patched_columns = [None] * len(indicators)
+    current_hashes = [None] * len(indicators)
+    block_store = BlockHashStore(cache_dir, mesh_hash) if args.incremental else None
+    if block_store is not None:
+        for i, (file_name_only, indicator_source) in enumerate(indicators):
+            indicator_tiles[i], patched_columns[i], current_hashes[i] = plan_incremental_merge(
+                file_name_only, indicator_source, tiles, df_column_relation, block_store, mesh_cache, args,
+                raster_cache)
+
+    raster_pool = None
+    if workers > 1:
+        # Each worker receives the mesh once and computes whole columns; the results are merged
+        # below in the order of indicator_tifs, so the output matches the serial run.
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                       initargs=(mesh.geometry, mesh_hash, args, mesh_type, raster_cache))
+        if args.shared_memory:
+            raster_pool = SharedRasterPool()
+            results = shared_memory_results(executor, raster_pool, indicator_sources, indicator_tiles, raster_cache,
+                                            debug)
+        else:
+            results = executor.map(compute_indicator_values_in_worker,
+                                   [source for source, its_tiles in zip(indicator_sources, indicator_tiles)
+                                    for _ in its_tiles],
+                                   [tile for its_tiles in indicator_tiles for tile in its_tiles])
+    else:
+        executor = None
+        results = (compute_indicator_values_safely(indicator_source, mesh_cache, args, membership_cache, mesh_type,
+                                                   raster_cache, tile)
+                   for indicator_source, its_tiles in zip(indicator_sources, indicator_tiles) for tile in its_tiles)
+    results = iter(results)
+
+    # New columns continue the numbering of a mesh that already has indicator columns
+    column_id = next_col_id
+
+    # Merge the columns of each .tif file found
+    for (file_name_only, indicator_source), its_tiles, columns, hashes in zip(indicators, indicator_tiles,
+                                                                             patched_columns, current_hashes):
+        if not its_tiles:
+            print(f"\n{file_name_only}: no block changed since the last merge. Columns kept")
+            continue
+        values, error = merge_tile_results(its_tiles, [next(results) for _ in its_tiles], len(mesh))
+        if error is not None:
+            print(f'ERROR in {file_name_only}: {error}\n')
+            continue
+
+        if columns is not None:
+            # Patch the existing columns of the indicator, only for the recomputed polygons
+            polygons = slice(None) if its_tiles[0] is None else np.concatenate(its_tiles)
+            for key, column_key in columns.items():
+                mesh.iloc[polygons, mesh.columns.get_loc(column_key)] = values[key][polygons]
+            print(f"\n{file_name_only}: columns {list(columns.values())} updated for "
+                  f"{len(mesh) if its_tiles[0] is None else len(polygons)} polygons")
+            mesh.to_file(updated_mesh_file_path)
+            df_column_relation.to_excel(column_relation_file_name, index=False)
+            block_store.put(file_name_only, hashes)
+            print("\nUpdated mesh saved to: ", updated_mesh_file_path)
+            continue
+
+        class_fractions = {band: values.pop((band, statistic)) for band, statistic in list(values)
+                           if statistic == 'classes'}
+        for band, fractions in class_fractions.items():
+            table = pd.DataFrame(fractions, columns=legend['label'].tolist())
+            table.insert(0, 'polygon', mesh.index)
+            table.insert(0, 'band', band)
+            table.insert(0, 'file_name', file_name_only)
+            df_class_fractions = pd.concat([df_class_fractions, table], ignore_index=True)
+
+        new_rows = []
+        for band, statistic in values:
+            # Create a new column key "I_n" for each band and statistic
+            column_key = 'I_' + str(column_id)
+            column_id += 1
+            mesh[column_key] = values[(band, statistic)]
 
-            # Print the current CRS
+            # Display the GeoDataFrame with the new column
             if debug:
-                print("Current CRS of the indicator:", crs_integer_indicator)
+                print(f"Column {column_key} (band {band}, {statistic}) in the mesh: ", mesh[column_key])
+
+            new_rows.append({'file_name': file_name_only, 'column': column_key, 'statistic': statistic,
+                             'band': band})
+
+        # Add the new rows to the DataFrame
+        df_column_relation = pd.concat([df_column_relation, pd.DataFrame(new_rows)], ignore_index=True)
+
+        # Save the DataFrame to an Excel file
+        df_column_relation.to_excel(column_relation_file_name, index=False)
+
+        # Save the updated mesh
+        mesh.to_file(updated_mesh_file_path)
+
+        print("\nUpdated mesh saved to: ", updated_mesh_file_path)
+        print("Columns relation file saved to: ", column_relation_file_name)
+
+        if class_fractions:
+            df_class_fractions.to_csv(class_fractions_file_name, index=False, encoding='utf-8')
+            print("Class fractions file saved to: ", class_fractions_file_name)
+
+        if block_store is not None:
+            block_store.put(file_name_only, hashes)
+
+    if block_store is not None and not os.path.exists(updated_mesh_file_path):
+        # Nothing changed: the output is still written, a copy of the input mesh
+        mesh.to_file(updated_mesh_file_path)
+        df_column_relation.to_excel(column_relation_file_name, index=False)
+
+    if executor is not None:
+        executor.shutdown()
+    if raster_pool is not None:
+        raster_pool.close()
+
+
+def shared_memory_results(executor, raster_pool, indicator_sources, indicator_tiles, raster_cache=None,
+                          debug=False):
+    """
+    Decode each raster once into shared memory and compute its tiles in the workers.
+
+    The rasters are shared one at a time: the segment of a raster is released as soon as all its
+    tiles are done, so at most one decoded raster is held in memory.
+
+    Yields:
+        (values, error) of each raster and tile, in the order of indicator_sources and indicator_tiles
+    """
+    for indicator_source, tiles in zip(indicator_sources, indicator_tiles):
+        if not tiles:
+            continue
+        with ExitStack() as stack:
+            try:
+                with open_indicator(indicator_source, raster_cache, debug) as indicator:
+                    info = stack.enter_context(raster_pool.share(indicator))
+            except Exception:
+                error = traceback.format_exc()
+                yield from [(None, error)] * len(tiles)
+                continue
+            yield from executor.map(compute_indicator_values_in_worker, [info] * len(tiles), tiles)
+
+
+def plan_incremental_merge(file_name_only, indicator_source, tiles, df_column_relation, block_store, mesh_cache,
+                           args, raster_cache=None):
+    """
+    Decide what to recompute for one indicator in incremental mode.
+
+    The block hashes of the raster are compared with those recorded at its last merge. When the
+    indicator already has a column for every requested (band, statistic), only the polygons
+    touching changed blocks are recomputed and those columns are patched; when the grid changed
+    or no hashes were recorded, all the polygons are recomputed into the same columns. Other
+    indicators get new columns, as without --incremental.
+
+    Returns:
+        Tuple (tiles, columns, hashes): the tiles to compute (empty when nothing changed), the
+        column of each (band, statistic) to patch (None to add new columns) and the current block
+        hashes, recorded once the indicator is written
+    """
+    with open_indicator(indicator_source, raster_cache, args.debug) as indicator:
+        hashes = block_hashes(indicator)
+        keys = {(band, statistic) for band in requested_bands(args, indicator)
+                for statistic in requested_statistics(args)}
+        columns = {}
+        if {'statistic', 'band'} <= set(df_column_relation.columns):
+            existing = df_column_relation[df_column_relation['file_name'] == file_name_only]
+            existing = existing.dropna(subset=['statistic', 'band'])
+            columns = {(int(row.band), row.statistic): row.column for row in existing.itertuples()}
+        if not keys <= set(columns):
+            return tiles, None, hashes
+        columns = {key: column for key, column in columns.items() if key in keys}
+
+        changed = changed_block_windows(block_store.get(file_name_only), hashes)
+        if changed is None:
+            print(f"{file_name_only}: no comparable block hashes, all polygons are recomputed")
+            return tiles, columns, hashes
+        polygons = window_polygons(indicator, mesh_cache.get(indicator.crs), changed)
+        print(f"{file_name_only}: {len(changed)} changed block(s), {len(polygons)} polygon(s) to recompute")
+
+    if tiles[0] is None:
+        return ([polygons] if len(polygons) else []), columns, hashes
+    tiles = [np.intersect1d(tile, polygons) for tile in tiles]
+    return [tile for tile in tiles if len(tile)], columns, hashes
+
+
+def merge_tile_results(tiles, tile_results, num_polygons):
+    """
+    Reassemble the per-tile results of one raster into one value per mesh polygon.
+
+    Args:
+        tiles: Polygon indices of each tile, or [None] when the mesh is not tiled
+        tile_results: (values, error) of each tile, as returned by compute_indicator_values_safely
+        num_polygons: Number of polygons in the mesh
+
+    Returns:
+        Tuple (values, error) for the whole mesh
+    """
+    if tiles[0] is None:
+        return tile_results[0]
+    errors = [error for _, error in tile_results if error is not None]
+    if errors:
+        return None, '\n'.join(errors)
+
+    values = {}
+    for polygons, (tile_values, _) in zip(tiles, tile_results):
+        for key, tile_value in tile_values.items():
+            values.setdefault(key, np.full((num_polygons,) + tile_value.shape[1:], -1.0))[polygons] = tile_value
+    return values, None
+
+
+def read_legend_classes(settings_labels_path):
+    """
+    Read the legend classes of a settings_labels.csv file (label;color;order;tag).
+
+    The 'order' of each class is the pixel value of that class in the classified rasters.
+    """
+    return pd.read_csv(settings_labels_path, sep=';').sort_values('order')
+
+
+def group_indicator_files(indicator_tifs, pattern=None):
+    """
+    Group the tiles of each indicator.
+
+    Args:
+        indicator_tifs: Paths to the indicator rasters
+        pattern: Regular expression searched in each file name. Files with the same match (its first
+            group, if any) are tiles of one indicator. Files without a match stay on their own
+
+    Returns:
+        List of (name, source) in the order of indicator_tifs: source is the path of a single raster
+        or the list of paths of the tiles of a mosaic
+    """
+    groups = {}
+    for indicator_file_path in indicator_tifs:
+        # Get the file name without extension
+        name = os.path.basename(indicator_file_path).split('.')[0]
+        match = re.search(pattern, os.path.basename(indicator_file_path)) if pattern is not None else None
+        if match is None:
+            groups[(name, indicator_file_path)] = indicator_file_path
+        else:
+            groups.setdefault((match.group(1) if match.groups() else match.group(0), None), []).append(indicator_file_path)
+    return [(name, source) for (name, _), source in groups.items()]
+
+
+def detect_mesh_type(mesh):
+    """Return 'line' or 'point' when every geometry of the mesh is a (multi)line or (multi)point, otherwise 'polygon'."""
+    if mesh.geom_type.isin(['LineString', 'MultiLineString']).all():
+        return 'line'
+    if mesh.geom_type.isin(['Point', 'MultiPoint']).all():
+        return 'point'
+    return 'polygon'
+
+
+def requested_statistics(args):
+    """Statistics written for each raster: --stats, or the mean/maximum chosen with --average."""
+    if args.stats is not None:
+        return parse_statistics(args.stats)
+    return ['mean' if args.average else 'max']
+
+
+def requested_bands(args, indicator):
+    """Bands aggregated for a raster: all of them but the alpha bands, the --bands list or only the first one."""
+    if args.bands is None:
+        return [1]
+    if args.bands == 'all':
+        # Alpha bands only mask the others (see zonal_statistics.read_values)
+        colorinterp = getattr(indicator, 'colorinterp', ())
+        return [band for band in indicator.indexes
+                if band > len(colorinterp) or colorinterp[band - 1] != ColorInterp.alpha]
+    bands = [int(band) for band in args.bands.split(',')]
+    missing = [band for band in bands if band not in indicator.indexes]
+    if missing:
+        raise ValueError(f"Bands {missing} not found. The raster has {indicator.count} band(s)")
+    return bands
+
+
+def open_indicator(indicator_file_path, raster_cache=None, debug=False):
+    """
+    Open the indicator raster, through its uncompressed memory-mapped copy when a RasterCache is given
+    (from a path or a CachedSource). A list of tile paths is opened as a virtual mosaic, and a
+    SharedRasterInfo attaches to the raster shared by the main process.
+    """
+    if isinstance(indicator_file_path, SharedRasterInfo):
+        return SharedRaster(indicator_file_path)
+    if isinstance(indicator_file_path, list):
+        return rio.open(build_mosaic_vrt(indicator_file_path))
+    if raster_cache is None:
+        return rio.open(indicator_file_path)
+    return raster_cache.open(indicator_file_path, debug=debug)
+
+
+def compute_indicator_values(indicator_file_path, mesh_cache, args, membership_cache, mesh_type='polygon',
+                             raster_cache=None, polygons=None):
+    """
+    Compute the columns of one indicator raster: the requested statistics of each mesh polygon.
+
+    Args:
+        indicator_file_path: Path to the indicator raster, CachedSource of it in raster_cache, list of
+            paths to the tiles of a mosaic or SharedRasterInfo of a raster in shared memory
+        mesh_cache: ProjectedMeshCache with the mesh geometries
+        args: Parsed command line arguments
+        membership_cache: MembershipCache shared by the rasters processed in this process
+        mesh_type: 'polygon', 'line' or 'point' (see detect_mesh_type)
+        raster_cache: RasterCache the raster is read through, None to read the file directly
+        polygons: Indices of the polygons of one spatial tile. None computes the whole mesh
+
+    Returns:
+        Dictionary with one array of values per mesh polygon for each (band, statistic)
+    """
+    if isinstance(indicator_file_path, SharedRasterInfo):
+        source_name = indicator_file_path.metadata['source']
+    elif isinstance(indicator_file_path, CachedSource):
+        source_name = indicator_file_path.path
+    else:
+        source_name = indicator_file_path
+    print(f"\nStarting the processing of file: {source_name} {datetime.now()}")
+
+    with open_indicator(indicator_file_path, raster_cache, args.debug) as indicator:
+        # Print the current CRS
+        if args.debug:
+            print("Current CRS of the indicator:", indicator.crs)
+            print(f"Shape of indicator: {indicator.shape}")
+
+        geometries = mesh_cache.get(indicator.crs)
+        if polygons is not None:
+            # Only the polygons of the tile, read from the window around them
+            geometries = geometries[polygons]
+            indicator = WindowedRaster(indicator, tile_window(indicator, geometries, args.tile_halo))
+            if membership_cache is not None:
+                membership_cache = membership_cache.subset(polygons)
+            if args.debug:
+                print(f"Tile of {len(polygons)} polygons, window {indicator.offset}")
+
+        if mesh_type == 'line':
+            return line_zonal_statistics(indicator, geometries, args.memory_budget, requested_statistics(args),
+                                         requested_bands(args, indicator))
+        if mesh_type == 'point':
+            return point_zonal_statistics(indicator, geometries, args.memory_budget, requested_statistics(args),
+                                          requested_bands(args, indicator), args.bilinear)
+        if args.engine != 'label':
+            return zonal_statistics(indicator, geometries, args.engine, memory_budget=args.memory_budget,
+                                    statistics=requested_statistics(args), bands=requested_bands(args, indicator))
+
+        options = dict(all_touched=args.all_touched, memory_budget=args.memory_budget,
+                       coverage_weighted=args.coverage_weighted, statistics=requested_statistics(args),
+                       bands=requested_bands(args, indicator))
+        if args.class_histograms is not None:
+            options['class_values'] = read_legend_classes(args.class_histograms)['order'].to_numpy()
+        if args.overview_tolerance is not None and indicator.overviews(1):
+            levels = overview_levels(indicator, geometries, args.overview_tolerance, args.overview_per_run)
+            if args.debug:
+                print("Polygons per overview level (-1 is the full resolution):",
+                      {int(level): int(count) for level, count in zip(*np.unique(levels, return_counts=True))})
+            return overview_zonal_statistics(indicator, geometries, levels, membership_cache, **options)
+        return label_zonal_statistics(indicator, geometries, membership_cache=membership_cache, **options)
+
+
+def compute_indicator_values_safely(indicator_file_path, mesh_cache, args, membership_cache, mesh_type='polygon',
+                                    raster_cache=None, polygons=None):
+    """
+    Same as compute_indicator_values, but returns the error instead of raising it.
+
+    Returns:
+        Tuple (values, error): error is None on success, otherwise the formatted traceback
+    """
+    try:
+        return compute_indicator_values(indicator_file_path, mesh_cache, args, membership_cache, mesh_type,
+                                        raster_cache, polygons), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+# State of each worker process, set once by init_worker
+_worker_state = {}
+
+
+def init_worker(mesh_geometry, mesh_hash, args, mesh_type, raster_cache):
+    _worker_state['mesh_cache'] = ProjectedMeshCache(mesh_geometry, mesh_hash, args.cache_dir)
+    _worker_state['args'] = args
+    _worker_state['mesh_type'] = mesh_type
+    _worker_state['raster_cache'] = raster_cache
+    _worker_state['membership_cache'] = MembershipCache(mesh_hash, args.cache_dir,
+                                                        keep_in_memory=args.memory_budget is None)
+
+
+def compute_indicator_values_in_worker(indicator_file_path, polygons=None):
+    return compute_indicator_values_safely(indicator_file_path, _worker_state['mesh_cache'],
+                                           _worker_state['args'], _worker_state['membership_cache'],
+                                           _worker_state['mesh_type'], _worker_state['raster_cache'], polygons)
 
-            mesh = mesh.to_crs(crs_integer_indicator)
 
-            # Print the current CRS of the mesh
-            if debug:
-                print("Current CRS of the mesh:", mesh.crs)
-
-            if debug:
-                print(f"Shape of indicator {i}: {pixel_values.shape}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
 
-            # Create a new column key "I_i" and set a float value
-            # For example, set the value -1 to all records
-            column_key = 'I_' + str(i)
-            mesh[column_key] = -1.0
+    parser.add_argument("--indicator_files_mask", required=True,
+                        help="Path to the indicator files mask. The glob function will be used to find the indicator files. Example: directory/*.tif")
 
-            # Display the GeoDataFrame with the new column
-            if debug:
-                print(f"Column {column_key} in the mesh: ", mesh[column_key])
+    parser.add_argument("--mesh_file", required=True,
+                        help="Path to the mesh file. Example: mesh.shp")
 
-            # Bring values from degrees to Cartesian plane
-            min_lat, max_lon, max_lat, min_lon = indicator.bounds
-            min_x, min_y = indicator.index(min_lat, min_lon)
-            max_x, max_y = indicator.index(max_lat, max_lon)
-            width, height = int(max_x - min_x), int(max_y - min_y)
+    parser.add_argument("--column_relation_file", required=True,
+                        help="Path to the columns relation file. Example: relation.xlsx")
 
-            num_polygons = len(mesh.geometry)
+    parser.add_argument("--new_mesh_file", required=True,
+                        help="Path to the new updated mesh file. Example: new_updated_mesh.shp")
 
-            # Create a progress bar with the number of polygons and display the elapsed time next to the value
-            with Bar(f'Processing {num_polygons} polygons of indicator {i}', max=num_polygons) as bar:
-                for idx, geometry in enumerate(mesh.geometry):
-                    # Transform multi-polygon into polygon
-                    geometry = convert_multi_to_single_polygon(geometry)
+    parser.add_argument("--average", action='store_true',
+                        help="Calculate the average of the pixel values within each mesh polygon. If False, take the maximum value.")
 
-                    polygons = np.zeros((width, height), dtype=np.uint8)
-                    pts = np.array([indicator.index(point[0], point[1]) for point in geometry.exterior.coords[:]], np.int32)[:, ::-1]
-                    pts = pts - np.array([min_y, min_x])
+    parser.add_argument("--debug", action='store_true',
+                        help="Activate debug mode.")
 
-                    cv2.fillPoly(polygons, [pts], 1)  # mask
+    parser.add_argument("--output_folder", default='output', required=True,
+                        help="Path to the directory that will be used to save the generated files.")
 
-                    x, y = np.where(polygons == 1)
-                    values = pixel_values[x, y]
-                    # Remove all negative values from the value list
-                    values = values[values >= 0]
+    parser.add_argument("--engine", choices=sorted(ENGINES), default='label',
+                        help="Zonal statistics engine. 'label' burns all polygons into one label raster and reduces them in a single pass; 'opencv' fills one mask per polygon (previous behaviour); 'numba' accumulates each polygon with a JIT-compiled scanline rasterizer, without masks (requires numba; statistics mean, max, min, std and count; supports --bands and --memory_budget).")
 
-                    # Check if the value list is not empty
-                    if len(values) > 0:
-                        max_value = np.nanmax(values)
-                        # Calculate the arithmetic mean
-                        arithmetic_mean = np.mean(values)
-                    else:
-                        # Set a default value for max_value when the list is empty (e.g., -1)
-                        max_value = -1.0
-                        # Set a default value for arithmetic_mean when the list is empty (e.g., -1)
-                        arithmetic_mean = -1.0
+    parser.add_argument("--all_touched", action='store_true',
+                        help="Label engine only: include every pixel touched by a polygon, not only the pixels whose centre is inside it.")
 
-                    # Insert the arithmetic mean or the maximum value into the column
-                    mesh.at[idx, column_key] = arithmetic_mean if is_average else max_value
+    parser.add_argument("--memory_budget", type=float, default=None,
+                        help="Label and numba engines: stream the raster in windows aligned to its native blocks, using at most this many megabytes per window. By default the whole band is read at once.")
 
-                    # Update the progress bar
-                    bar.next()
+    parser.add_argument("--cache_dir", default=None,
+                        help="Folder where the mesh projected to each raster CRS and, for the label engine, the polygon to pixel membership of each raster grid are persisted and reused across runs.")
 
-            # New row to be added
-            new_row = {'file_name': file_name_only, 'column': column_key}
+    parser.add_argument("--raster_cache_dir", default=None,
+                        help="Folder where an uncompressed, memory-mapped copy of each indicator raster is kept, keyed by the file hash. Later runs read it without decompressing the GeoTIFF again.")
 
-            # Add the new row to the DataFrame
-            df_column_relation = df_column_relation.append(new_row, ignore_index=True)
+    parser.add_argument("--canonical_resolution", type=float, default=config.CANONICAL_RESOLUTION,
+                        help="Pixel size, in units of the default CRS, of the canonical analysis grid. Every raster is warped once onto this grid (config.CANONICAL_GRID_BOUNDS, or the mesh bounds) and cached in --raster_cache_dir, so all of them share one polygon membership.")
 
-            # Save the DataFrame to an Excel file
-            df_column_relation.to_excel(column_relation_file_name, index=False)
+    parser.add_argument("--mosaic_group_pattern", default=None,
+                        help="Regular expression searched in the file names. Files with the same match (its first group, if any) are tiles of one indicator, read as a virtual mosaic and written to one column. Example: '^(.*)_tile\\d+'")
 
-            # Change the CRS of the mesh to the default CRS
-            mesh = mesh.to_crs(CRS.from_epsg(config.DEFAULT_CRS))
+    parser.add_argument("--class_histograms", default=None,
+                        help="Label engine only: path to a settings_labels.csv legend (label;color;order;tag). The share of each polygon's pixels in each class, whose pixel value is its 'order', is computed in the same pass and written next to the new mesh as <new_mesh_file>_classes.csv. Example: data/settings_labels.csv")
 
-            # Save the updated mesh
-            mesh.to_file(updated_mesh_file_path)
+    parser.add_argument("--tile_size", type=float, default=None,
+                        help="Split the mesh into square tiles of this side, in units of the default CRS, processed as separate tasks (in parallel with --workers) that read only the raster window around their polygons. Each polygon belongs to the tile of its representative point. Example: 500000")
 
-            print("\nUpdated mesh saved to: ", updated_mesh_file_path)
-            print("Columns relation file saved to: ", column_relation_file_name)
+    parser.add_argument("--tile_halo", type=int, default=1,
+                        help="Pixels added around the window of each tile.")
 
-            # Close the indicator
-            indicator.close()
+    parser.add_argument("--shared_memory", action='store_true',
+                        help="With --workers: decode each raster once in the main process into shared memory, so the workers (usually one per --tile_size tile) read the same pixels without copies. Rasters are shared one at a time and the segments are removed when done, at exit, or on the next run after a crash.")
 
-        except Exception as ex:
-            print(f'ERROR: {ex}\n')
-            # Print the error traceback
-            print(traceback.format_exc())
+    parser.add_argument("--incremental", action='store_true',
+                        help="Requires --cache_dir. Record a hash of every block of each merged raster and, for indicators already in the columns relation file (pass the previous output as --mesh_file), recompute only the polygons touching blocks changed since their last merge, patching their I_n columns in place. Run it from the first merge so that the hashes exist.")
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes computing indicator rasters in parallel. The columns are written in the same order as in the serial run.")
 
-    parser.add_argument("--indicator_files_mask", required=True,
-                        help="Path to the indicator files mask. The glob function will be used to find the indicator files. Example: directory/*.tif")
+    parser.add_argument("--coverage_weighted", action='store_true',
+                        help="Label engine only: weight each pixel by the exact fraction of it covered by the polygon, so narrow polygons (buffered roads and railways) still get values.")
 
-    parser.add_argument("--mesh_file", required=True,
-                        help="Path to the mesh file. Example: mesh.shp")
+    parser.add_argument("--stats", default=None,
+                        help="Label and numba engines: comma separated statistics computed in the same pass, one I_n column each, recorded in the columns relation file. Options: mean, max, min, std, count, median and percentiles such as p90 (the numba engine computes mean, max, min, std and count). Overrides --average.")
 
-    parser.add_argument("--column_relation_file", required=True,
-                        help="Path to the columns relation file. Example: relation.xlsx")
+    parser.add_argument("--bands", default=None,
+                        help="Label and numba engines: bands aggregated in the same pass, one I_n column per band and statistic. Use 'all' or a comma separated list such as 1,3,5. By default only band 1 is used.")
 
-    parser.add_argument("--new_mesh_file", required=True,
-                        help="Path to the new updated mesh file. Example: new_updated_mesh.shp")
+    parser.add_argument("--overview_tolerance", type=float, default=None,
+                        help="Label engine only: read each polygon from the coarsest internal overview (COG) whose pixel area is at most this fraction of the polygon area. Example: 0.01 keeps about 100 pixels per polygon.")
 
-    parser.add_argument("--average", action='store_true',
-                        help="Calculate the average of the pixel values within each mesh polygon. If False, take the maximum value.")
+    parser.add_argument("--overview_per_run", action='store_true',
+                        help="With --overview_tolerance, use a single overview level for the whole run, the one allowed for the smallest polygon.")
 
-    parser.add_argument("--debug", action='store_true',
-                        help="Activate debug mode.")
+    parser.add_argument("--mesh_type", choices=['auto', 'polygon', 'line', 'point'], default='auto',
+                        help="How the mesh is merged. 'line' samples the raster along each line at pixel spacing instead of filling polygons and 'point' reads the pixel under each point; 'auto' picks them when every geometry is a line or a point.")
 
-    parser.add_argument("--output_folder", default='output', required=True,
-                        help="Path to the directory that will be used to save the generated files.")
+    parser.add_argument("--bilinear", action='store_true',
+                        help="Point meshes only: interpolate between the four closest pixel centres instead of taking the pixel under the point.")
 
     args = parser.parse_args()
+    if args.stats is not None:
+        try:
+            parse_statistics(args.stats)
+        except ValueError as ex:
+            parser.error(str(ex))
+        if args.engine == 'opencv':
+            parser.error("--stats requires the label or numba engine")
+    if args.class_histograms is not None and args.engine != 'label':
+        parser.error("--class_histograms requires the label engine")
+    if args.overview_tolerance is not None and args.engine == 'opencv':
+        parser.error("--overview_tolerance requires the label engine")
+    if args.bands is not None:
+        if args.bands != 'all' and not all(band.strip().isdigit() for band in args.bands.split(',')):
+            parser.error("--bands must be 'all' or a comma separated list of band numbers")
+        if args.engine == 'opencv':
+            parser.error("--bands requires the label or numba engine")
+    if args.engine == 'numba':
+        if njit is None:
+            parser.error("--engine numba requires the numba package (pip install numba)")
+        if args.all_touched or args.coverage_weighted or args.overview_tolerance is not None:
+            parser.error("--all_touched, --coverage_weighted and --overview_tolerance require the label engine")
+        if args.stats is not None and not set(parse_statistics(args.stats)) <= set(SCANLINE_STATISTICS):
+            parser.error(f"--engine numba computes only {', '.join(SCANLINE_STATISTICS)}")
+    if args.shared_memory and args.workers < 2:
+        parser.error("--shared_memory requires --workers")
+    if args.canonical_resolution is not None and args.raster_cache_dir is None:
+        parser.error("--canonical_resolution requires --raster_cache_dir")
+    if args.incremental and args.cache_dir is None:
+        parser.error("--incremental requires --cache_dir, where the block hashes are kept")
+    if args.incremental and args.class_histograms is not None:
+        parser.error("--incremental cannot update the --class_histograms file")
 
     initial_time = time.time()
     main(args)
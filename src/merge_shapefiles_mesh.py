@@ -17,7 +17,9 @@ import time
 import warnings
 
 # Custom utility functions and configurations
-from utilities import create_folder_if_not_exists, load_shapefile, find_indicator_column
+from utilities import (create_folder_if_not_exists, load_shapefile, find_indicator_column, grouped_weighted_average,
+                       pairwise_intersection_area)
+from mesh_join import MeshJoin
 import config
 
 # Progress bar library
@@ -36,6 +38,7 @@ def main(args):
     debug = args.debug
     output_folder_path = args.output_folder
     target_filters = args.target_filters
+    overlap_weighted = args.overlap_weighted
 
     if debug:
         print("\nCommand line arguments:")
@@ -47,6 +50,7 @@ def main(args):
         print("Debug mode:", debug)
         print("Output folder:", output_folder_path)
         print("Target Filters:", target_filters)
+        print("Overlap weighted:", overlap_weighted)
         print("Default CRS:", config.DEFAULT_CRS, "\n")
 
     # Create output folder if it doesn't exist
@@ -67,6 +71,8 @@ def main(args):
     if 'CL_ORIG' in mesh.columns:
         mesh.drop('CL_ORIG', inplace=True, axis=1)
     mesh_file_pk = 'mesh_file_pk'
+    # Spatial index of the mesh, built once and queried with every indicator
+    mesh_join = MeshJoin(mesh)
     # Get next column ID
     nextColId = 1
     if 'I_1' in mesh.columns:
@@ -121,8 +127,7 @@ def main(args):
                 if debug:
                     print(f'ERROR: Column not found in {indicator_file_path}')
                 new_row = {'file_name': file_name_only, 'column': col_name}
-                df_column_relation = df_column_relation.append(
-                    new_row, ignore_index=True)
+                df_column_relation = pd.concat([df_column_relation, pd.DataFrame([new_row])], ignore_index=True)
                 continue
             else:
                 indicator.rename(columns={col_name: "CL_ORIG"}, inplace=True)
@@ -149,14 +154,19 @@ def main(args):
                 print("New CRS of the indicator:", indicator.crs)
 
             # Perform the spatial join based on geometry intersection
-            intersection = gpd.sjoin(
-                mesh, indicator, how='inner', op='intersects')
+            intersection = mesh_join.join(indicator)
 
             # Calculate the weighted average or maximum value
             if is_average:
-                intersection['weight'] = intersection.geometry.area
-                weighted_avg = intersection.groupby(mesh_file_pk).apply(
-                    lambda x: sum(x['CL_ORIG'] * x['weight']) / sum(x['weight']))
+                if overlap_weighted:
+                    # Area of the overlap of each mesh segment with each indicator polygon, for all pairs at once
+                    intersection['weight'] = pairwise_intersection_area(
+                        intersection.geometry.values, indicator.geometry.loc[intersection['index_right']].values)
+                else:
+                    intersection['weight'] = intersection.geometry.area
+                # Sums of value*weight and weight per mesh segment, without a Python call per group
+                weighted_avg = grouped_weighted_average(intersection[mesh_file_pk], intersection['CL_ORIG'],
+                                                        intersection['weight'])
                 mesh[f'I_{i}'] = mesh[mesh_file_pk].map(weighted_avg)
             else:
                 max_value = intersection.groupby(mesh_file_pk)['CL_ORIG'].max()
@@ -166,8 +176,7 @@ def main(args):
             new_row = {'file_name': file_name_only, 'column': f'I_{i}'}
 
             # Add the new row to the DataFrame
-            df_column_relation = df_column_relation.append(
-                new_row, ignore_index=True)
+            df_column_relation = pd.concat([df_column_relation, pd.DataFrame([new_row])], ignore_index=True)
 
             # Save the DataFrame to an Excel file
             df_column_relation.to_excel(column_relation_file_name, index=False)
@@ -204,7 +213,12 @@ if __name__ == "__main__":
     parser.add_argument("--target_filters", default=None, required=False,
                         help="Filter collumns")
 
+    parser.add_argument("--overlap_weighted", action='store_true',
+                        help="With --average: weight each indicator polygon by the area of its overlap with the mesh segment. By default every intersecting polygon weighs the area of the segment, which gives a plain mean. Segments that only touch indicator polygons get no value.")
+
     args = parser.parse_args()
+    if args.overlap_weighted and not args.average:
+        parser.error("--overlap_weighted requires --average")
 
     initial_time = time.time()
     main(args)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Spatial join of a fixed mesh with many indicator layers.
+#
+# gpd.sjoin builds or re-derives a spatial index on every call, although the mesh does not
+# change during a run. MeshJoin builds the STRtree of the mesh once and answers one bulk
+# query per indicator with the whole geometry array of the indicator.
+
+# Numerical processing library
+import numpy as np
+
+# Data manipulation and geospatial libraries
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+
+class MeshJoin:
+    """
+    STRtree of the mesh geometries, built once and bulk-queried with each indicator layer.
+
+    Args:
+        mesh: GeoDataFrame of the mesh. The tree covers its current geometries; attribute columns
+            added later (the I_n columns of a merge) are included in join
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.tree = shapely.STRtree(np.asarray(mesh.geometry.values, dtype=object))
+
+    def pairs(self, geometries, predicate='intersects'):
+        """
+        Positions of the (mesh, indicator) geometry pairs satisfying the predicate.
+
+        Args:
+            geometries: Array of shapely geometries of the indicator, in the mesh CRS
+            predicate: Binary predicate evaluated as predicate(indicator geometry, mesh geometry),
+                as in shapely.STRtree.query
+
+        Returns:
+            Tuple (mesh_indices, indicator_indices) of integer arrays, sorted by mesh position and
+            then by indicator position, the row order of gpd.sjoin(mesh, indicator)
+        """
+        indicator_indices, mesh_indices = self.tree.query(np.asarray(geometries, dtype=object), predicate=predicate)
+        order = np.lexsort((indicator_indices, mesh_indices))
+        return mesh_indices[order], indicator_indices[order]
+
+    def join(self, indicator, predicate='intersects'):
+        """
+        Inner spatial join of the mesh with an indicator layer.
+
+        Gives the same frame as gpd.sjoin(mesh, indicator, how='inner', predicate=predicate): the
+        mesh rows and index, the indicator index as 'index_right' and the indicator attributes,
+        with the '_left' and '_right' suffixes on the columns present in both.
+
+        Args:
+            indicator: GeoDataFrame of the indicator, in the mesh CRS
+            predicate: Binary predicate, see pairs
+
+        Returns:
+            GeoDataFrame with one row per (mesh, indicator) pair
+        """
+        mesh_indices, indicator_indices = self.pairs(indicator.geometry.values, predicate)
+        left = self.mesh.iloc[mesh_indices]
+        right = pd.DataFrame(indicator.drop(columns=indicator.geometry.name).iloc[indicator_indices])
+
+        shared = set(left.columns) & set(right.columns)
+        left = left.rename(columns={column: f'{column}_left' for column in shared})
+        right = right.rename(columns={column: f'{column}_right' for column in shared})
+        right.insert(0, 'index_right', indicator.index[indicator_indices])
+        right.index = left.index
+
+        joined = pd.concat([left, right], axis=1)
+        return gpd.GeoDataFrame(joined, geometry=left.geometry.name, crs=self.mesh.crs)
@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Uncompressed, memory-mapped copies of the indicator rasters.
+#
+# The indicator GeoTIFFs are DEFLATE/LZW compressed, so every merge decompresses the same
+# data again. The cache stores each raster once as a raw .npy array (bands, rows, columns)
+# next to a small JSON file with its georeferencing; later runs map it straight from the
+# OS page cache without any decoding. Decoded rasters can also be placed in shared memory,
+# so that the worker processes of a run read the same pixels without copies.
+
+# System utility libraries
+import atexit
+import hashlib
+import json
+import math
+import os
+import tempfile
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+# Numerical processing library
+import numpy as np
+
+# Geospatial data processing libraries
+import rasterio as rio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import ColorInterp, MaskFlags
+from rasterio.transform import TransformMethodsMixin
+from rasterio.windows import Window, WindowMethodsMixin
+
+# My utility functions
+from utilities import reproject_raster
+
+
+# Pixel grid shared by every raster of an analysis: CRS, affine transform and size in pixels
+Grid = namedtuple('Grid', ['crs', 'transform', 'width', 'height'])
+
+
+def canonical_grid(bounds, resolution, crs) -> Grid:
+    """
+    Build the canonical analysis grid covering the given bounds.
+
+    The grid origin is snapped to a multiple of the resolution, so grids built for overlapping
+    bounds are pixel aligned.
+
+    Args:
+        bounds: (left, bottom, right, top) to cover, in the grid CRS
+        resolution: Pixel size, in units of the grid CRS
+        crs: CRS of the grid, e.g. config.DEFAULT_CRS
+
+    Returns:
+        Grid covering the bounds
+    """
+    left, bottom, right, top = bounds
+    left = math.floor(left / resolution) * resolution
+    top = math.ceil(top / resolution) * resolution
+    width = max(1, math.ceil((right - left) / resolution))
+    height = max(1, math.ceil((top - bottom) / resolution))
+    return Grid(CRS.from_user_input(crs), Affine(resolution, 0.0, left, 0.0, -resolution, top), width, height)
+
+
+def file_hash(path, chunk_size=16 * 1024 * 1024) -> str:
+    """
+    Hash the content of a file.
+
+    Args:
+        path: Path to the file
+        chunk_size: Number of bytes read at once
+
+    Returns:
+        SHA-1 hex digest of the file content
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def has_dataset_mask(dataset) -> bool:
+    """True when the raster has a mask or alpha band, beyond the pixels equal to its nodata value."""
+    return any(flags not in ([MaskFlags.all_valid], [MaskFlags.nodata])
+               for flags in getattr(dataset, 'mask_flag_enums', ()))
+
+
+def read_validity(dataset, out):
+    """
+    Write the validity of every pixel of a raster with a mask or alpha band into out (rows, columns).
+
+    A pixel is valid when it is valid in every band, so per-band masks are combined. Read in strips
+    of rows, not to hold a whole band mask next to out.
+    """
+    rows = max(1, (64 * 1024 * 1024) // max(dataset.width, 1))
+    for row in range(0, dataset.height, rows):
+        window = Window(0, row, dataset.width, min(rows, dataset.height - row))
+        out[row:row + window.height] = (dataset.read_masks(window=window) > 0).all(axis=0)
+
+
+class ArrayRaster(TransformMethodsMixin, WindowMethodsMixin):
+    """
+    Read-only raster backed by an in-memory array (bands, rows, columns).
+
+    Exposes the subset of the rasterio dataset interface used by the zonal statistics
+    engines (read, transform, window_transform, index, ...), so it can be passed wherever
+    an open rasterio dataset is expected.
+
+    Args:
+        array: Array (bands, rows, columns) of the values
+        metadata: Georeferencing, nodata, scales and colour interpretation of the raster
+        valid: Boolean array (rows, columns) with the mask or alpha band of the raster, or None
+    """
+
+    def __init__(self, array, metadata, valid=None):
+        self.name = metadata['source']
+        self.array = array
+        self.valid = valid
+        self.count, self.height, self.width = self.array.shape
+        self.shape = (self.height, self.width)
+        self.indexes = tuple(range(1, self.count + 1))
+        self.dtypes = (self.array.dtype.name,) * self.count
+        self.nodata = metadata['nodata']
+        if valid is not None:
+            self.mask_flag_enums = ([MaskFlags.per_dataset],) * self.count
+        elif self.nodata is not None:
+            self.mask_flag_enums = ([MaskFlags.nodata],) * self.count
+        else:
+            self.mask_flag_enums = ([MaskFlags.all_valid],) * self.count
+        self.colorinterp = tuple(ColorInterp[name] for name in metadata.get('colorinterp', ('gray',) * self.count))
+        self.scales = tuple(metadata.get('scales', (1.0,) * self.count))
+        self.offsets = tuple(metadata.get('offsets', (0.0,) * self.count))
+        self.crs = CRS.from_wkt(metadata['crs'])
+        self.transform = Affine(*metadata['transform'])
+        self.res = (abs(self.transform.a), abs(self.transform.e))
+        self.bounds = rio.coords.BoundingBox(*rio.transform.array_bounds(self.height, self.width, self.transform))
+        # Rows are contiguous in the array, so full-width strips are the cheapest reads
+        self.block_shapes = [(1, self.width)] * self.count
+
+    def read(self, indexes=None, window=None, masked=False, out_dtype=None):
+        """
+        Read bands like rasterio.DatasetReader.read. The values are copied out of the memory map.
+
+        Args:
+            indexes: Band number or list of band numbers (1-based). None reads every band
+            window: Rasterio window to read. None reads the whole raster
+            masked: Return a masked array with the pixels equal to the nodata value, or invalid in the
+                mask or alpha band of the raster, masked
+            out_dtype: Cast the values to this dtype
+
+        Returns:
+            Array (rows, columns) for a single band, otherwise (bands, rows, columns)
+        """
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+
+        if indexes is None:
+            indexes = list(self.indexes)
+        if isinstance(indexes, int):
+            values = np.array(self.array[indexes - 1, row_start:row_stop, col_start:col_stop])
+        else:
+            values = self.array[np.asarray(indexes) - 1, row_start:row_stop, col_start:col_stop]
+
+        if masked:
+            if self.nodata is None:
+                mask = np.zeros(values.shape, dtype=bool)
+            elif np.isnan(self.nodata):
+                mask = np.isnan(values)
+            else:
+                mask = values == self.nodata
+            if self.valid is not None:
+                mask |= ~self.valid[row_start:row_stop, col_start:col_stop]
+        if out_dtype is not None:
+            values = values.astype(out_dtype, copy=False)
+        return np.ma.MaskedArray(values, mask=mask) if masked else values
+
+    def read_masks(self, indexes=None, window=None):
+        """Read the masks of bands like rasterio.DatasetReader.read_masks: 255 for valid pixels, 0 otherwise."""
+        mask = np.ma.getmaskarray(self.read(indexes, window, masked=True))
+        return np.where(mask, 0, 255).astype(np.uint8)
+
+    def overviews(self, band):
+        """The cached copy keeps only the full resolution."""
+        return []
+
+    def close(self):
+        self.array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CachedRaster(ArrayRaster):
+    """Read-only raster backed by a memory-mapped .npy array of the raster cache."""
+
+    def __init__(self, array_path, metadata):
+        valid = np.load(mask_path(array_path), mmap_mode='r') if metadata.get('masked') else None
+        super().__init__(np.load(array_path, mmap_mode='r'), metadata, valid)
+
+
+def mask_path(array_path):
+    """Path of the validity array stored next to the values of a cached raster with a mask or alpha band."""
+    return array_path[:-len('.npy')] + '.mask.npy'
+
+
+def raster_metadata(dataset):
+    """Metadata kept with a cached or shared copy of a raster."""
+    return {'crs': dataset.crs.to_wkt(), 'transform': list(dataset.transform)[:6], 'nodata': dataset.nodata,
+            'scales': list(dataset.scales), 'offsets': list(dataset.offsets),
+            'colorinterp': [interp.name for interp in dataset.colorinterp], 'masked': has_dataset_mask(dataset)}
+
+
+# Prefix of the shared memory segments, followed by the PID of the owner process
+SHARED_SEGMENT_PREFIX = 'preprocessing_raster_'
+
+# Picklable description of a raster in shared memory, sent to the workers instead of the pixels
+SharedRasterInfo = namedtuple('SharedRasterInfo', ['segment', 'shape', 'dtype', 'metadata'])
+
+
+def _open_segment(name, create=False, size=0):
+    """
+    Create a shared memory segment, or attach to an existing one without tracking it.
+
+    The owner's segment is registered with the multiprocessing resource tracker, which unlinks it if
+    the owner dies. Workers only attach: registering them too would unlink the segment when the
+    first worker exits.
+    """
+    if create:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers every attached segment: skip the registration
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def cleanup_stale_segments():
+    """
+    Remove the shared memory segments left by runs that crashed or were killed.
+
+    Returns:
+        Number of segments removed
+    """
+    if not os.path.isdir('/dev/shm'):
+        return 0
+    removed = 0
+    for name in os.listdir('/dev/shm'):
+        if not name.startswith(SHARED_SEGMENT_PREFIX):
+            continue
+        try:
+            os.kill(int(name[len(SHARED_SEGMENT_PREFIX):].split('_')[0]), 0)
+        except ProcessLookupError:
+            # The owner is gone
+            os.remove(os.path.join('/dev/shm', name))
+            removed += 1
+        except (ValueError, PermissionError):
+            continue
+    return removed
+
+
+class SharedRaster(ArrayRaster):
+    """Read-only raster attached to a shared memory segment created by SharedRasterPool."""
+
+    def __init__(self, info):
+        self.segment = _open_segment(info.segment)
+        array = np.ndarray(info.shape, dtype=info.dtype, buffer=self.segment.buf)
+        # The validity of a raster with a mask or alpha band follows its values in the segment
+        valid = (np.ndarray(info.shape[1:], dtype=bool, buffer=self.segment.buf, offset=array.nbytes)
+                 if info.metadata.get('masked') else None)
+        super().__init__(array, info.metadata, valid)
+
+    def close(self):
+        self.array = None
+        self.valid = None
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+
+class SharedRasterPool:
+    """
+    Owner of the shared memory segments of a run.
+
+    Rasters are decoded once by the owner into a segment, and the workers attach to it through
+    the SharedRasterInfo. Segments are unlinked when their raster is done, when the pool is
+    closed and at interpreter exit; segments of runs that were killed are removed the next time
+    a pool is created.
+    """
+
+    def __init__(self):
+        self.segments = {}
+        cleanup_stale_segments()
+        atexit.register(self.close)
+
+    @contextmanager
+    def share(self, dataset):
+        """
+        Copy every band of an open raster into shared memory for the duration of the block.
+
+        Args:
+            dataset: Open rasterio dataset (or raster of this module)
+
+        Yields:
+            SharedRasterInfo to open the raster in the workers with SharedRaster
+        """
+        shape = (dataset.count, dataset.height, dataset.width)
+        dtype = np.dtype(dataset.dtypes[0])
+        metadata = raster_metadata(dataset)
+        metadata['source'] = dataset.name
+        size = int(np.prod(shape)) * dtype.itemsize
+        name = f'{SHARED_SEGMENT_PREFIX}{os.getpid()}_{uuid.uuid4().hex[:12]}'
+        segment = _open_segment(name, create=True,
+                                size=max(size + (dataset.height * dataset.width if metadata['masked'] else 0), 1))
+        self.segments[name] = segment
+        try:
+            array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            for band in range(1, dataset.count + 1):
+                array[band - 1] = dataset.read(band)
+            del array
+            if metadata['masked']:
+                valid = np.ndarray(shape[1:], dtype=bool, buffer=segment.buf, offset=size)
+                read_validity(dataset, valid)
+                del valid
+            yield SharedRasterInfo(name, shape, dtype.str, metadata)
+        finally:
+            self.release(name)
+
+    def release(self, name):
+        segment = self.segments.pop(name, None)
+        if segment is not None:
+            try:
+                segment.close()
+            except BufferError:
+                # An array still points to the buffer (failed copy): the unlink below frees it anyway
+                pass
+            segment.unlink()
+
+    def close(self):
+        for name in list(self.segments):
+            self.release(name)
+
+
+class WindowedRaster(TransformMethodsMixin, WindowMethodsMixin):
+    """
+    View of a window of an open raster, exposed as a raster of its own.
+
+    Used to limit a zonal computation to the pixels of one spatial tile: the engines see a small
+    raster whose transform and size are those of the window, and every read is forwarded to the
+    parent dataset with the offsets of the window.
+    """
+
+    def __init__(self, dataset, window):
+        self.dataset = dataset
+        self.offset = window
+        self.name = dataset.name
+        self.width, self.height = int(window.width), int(window.height)
+        self.shape = (self.height, self.width)
+        self.count = dataset.count
+        self.indexes = dataset.indexes
+        self.dtypes = dataset.dtypes
+        self.nodata = dataset.nodata
+        self.mask_flag_enums = getattr(dataset, 'mask_flag_enums', ())
+        self.colorinterp = getattr(dataset, 'colorinterp', ())
+        self.scales, self.offsets = dataset.scales, dataset.offsets
+        self.crs = dataset.crs
+        self.transform = dataset.window_transform(window)
+        self.res = dataset.res
+        self.bounds = rio.coords.BoundingBox(*dataset.window_bounds(window))
+        self.block_shapes = dataset.block_shapes
+
+    def read(self, indexes=None, window=None, **kwargs):
+        """Read bands like rasterio.DatasetReader.read, with the window relative to this view."""
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        window = Window(self.offset.col_off + window.col_off, self.offset.row_off + window.row_off,
+                        window.width, window.height)
+        return self.dataset.read(indexes, window=window, **kwargs)
+
+    def read_masks(self, indexes=None, window=None):
+        """Read the band masks like rasterio.DatasetReader.read_masks, with the window relative to this view."""
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        return self.dataset.read_masks(indexes, window=Window(self.offset.col_off + window.col_off,
+                                                              self.offset.row_off + window.row_off,
+                                                              window.width, window.height))
+
+    def overviews(self, band):
+        """Overviews of the parent dataset, read through its name by the overview engine."""
+        return self.dataset.overviews(band)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Raster of a RasterCache with its key already computed. Sent to the tasks of a run instead of the
+# path, so the source file is hashed once and not once per (raster, tile) task
+CachedSource = namedtuple('CachedSource', ['path', 'key'])
+
+
+# Version of the cached copies, part of their cache key (2: with the mask or alpha band of the
+# raster and its colour interpretation)
+ENTRY_VERSION = 2
+
+# Version of the rasters warped onto a canonical grid, part of their cache key. Bumped when the warp
+# changes, so entries written by previous versions are not read (2: the grid outside the raster is
+# filled with an undeclared negative value instead of a declared -9999 nodata; 3: and masked for
+# unsigned rasters)
+GRID_ENTRY_VERSION = 3
+
+
+class RasterCache:
+    """
+    Directory of uncompressed, memory-mapped copies of rasters, keyed by the source file hash.
+
+    Each entry holds every band of the raster, after an optional reprojection through
+    utilities.reproject_raster, as '<key>.npy' plus its transform, CRS and nodata in '<key>.json'.
+    Rasters with a mask or alpha band also keep the validity of each pixel in '<key>.mask.npy'.
+    Changing the source file changes its hash, so stale entries are never read.
+
+    With a canonical grid every raster is warped once onto it, whatever its CRS and resolution.
+    All the cached rasters then share one transform and shape, so the mesh is projected and its
+    polygon membership computed only once for all of them.
+    """
+
+    def __init__(self, cache_dir, grid=None):
+        self.cache_dir = cache_dir
+        self.grid = grid
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path, to_crs=None):
+        parts = [file_hash(path), str(ENTRY_VERSION)]
+        if self.grid is not None:
+            parts.append(repr((self.grid.crs.to_wkt(), tuple(self.grid.transform)[:6], self.grid.width,
+                               self.grid.height, GRID_ENTRY_VERSION)))
+        elif to_crs is not None:
+            parts.append(CRS.from_user_input(to_crs).to_wkt())
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def source(self, path, to_crs=None) -> CachedSource:
+        """Path of a raster with its key, to open it several times hashing the file only once."""
+        return CachedSource(path, self.key(path, to_crs))
+
+    def open(self, path, to_crs=None, debug=False):
+        """
+        Open the cached copy of a raster, creating it on the first use.
+
+        Args:
+            path: Path to the source raster, or CachedSource of it (see source)
+            to_crs: CRS the raster is reprojected to before caching. None keeps the source CRS. Ignored
+                when the cache has a canonical grid. A CachedSource keeps the CRS of its key
+            debug: Print the cache hits and misses
+
+        Returns:
+            CachedRaster with the raster values
+        """
+        if isinstance(path, CachedSource):
+            path, key = path
+        else:
+            key = self.key(path, to_crs)
+        array_path = os.path.join(self.cache_dir, f'{key}.npy')
+        metadata_path = os.path.join(self.cache_dir, f'{key}.json')
+
+        if not (os.path.exists(array_path) and os.path.exists(metadata_path)):
+            if debug:
+                print(f"Raster cache miss, decompressing {path}")
+            self._store(path, to_crs, array_path, metadata_path)
+        elif debug:
+            print(f"Raster cache hit for {path}")
+
+        with open(metadata_path) as file:
+            metadata = json.load(file)
+        metadata['source'] = path
+        return CachedRaster(array_path, metadata)
+
+    def _store(self, path, to_crs, array_path, metadata_path):
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp_dir:
+            source_path = path
+            reprojected_path = os.path.join(tmp_dir, 'reprojected.tif')
+            if self.grid is not None:
+                source_path = reproject_raster(path, reprojected_path, self.grid.crs, transform=self.grid.transform,
+                                               width=self.grid.width, height=self.grid.height)
+            else:
+                with rio.open(path) as source:
+                    needs_reprojection = to_crs is not None and source.crs != CRS.from_user_input(to_crs)
+                if needs_reprojection:
+                    source_path = reproject_raster(path, reprojected_path, to_crs)
+
+            # Written to a temporary file and moved into place, so an interrupted run never leaves a partial entry
+            tmp_array_path = os.path.join(tmp_dir, 'array.npy')
+            with rio.open(source_path) as source:
+                array = np.lib.format.open_memmap(tmp_array_path, mode='w+', dtype=source.dtypes[0],
+                                                  shape=(source.count, source.height, source.width))
+                for band in source.indexes:
+                    array[band - 1] = source.read(band)
+                array.flush()
+                del array
+                metadata = raster_metadata(source)
+                if metadata['masked']:
+                    valid = np.lib.format.open_memmap(mask_path(tmp_array_path), mode='w+', dtype=bool,
+                                                      shape=(source.height, source.width))
+                    read_validity(source, valid)
+                    valid.flush()
+                    del valid
+
+            tmp_metadata_path = os.path.join(tmp_dir, 'metadata.json')
+            with open(tmp_metadata_path, 'w') as file:
+                json.dump(metadata, file)
+            os.replace(tmp_array_path, array_path)
+            if metadata['masked']:
+                os.replace(mask_path(tmp_array_path), mask_path(array_path))
+            # The metadata is moved last: an entry exists once its metadata does
+            os.replace(tmp_metadata_path, metadata_path)
+
+
+# Smallest side, in pixels, of the blocks hashed by block_hashes. Striped rasters (one row per block)
+# are hashed in strips of several rows
+HASH_BLOCK_MIN_ROWS = 256
+
+
+def block_hashes(dataset) -> dict:
+    """
+    SHA-1 of every block of the raster, over all its bands.
+
+    The blocks follow the internal tiles of the raster; strips are grouped into blocks of at least
+    HASH_BLOCK_MIN_ROWS rows. Each strip of blocks is read once per band.
+
+    Returns:
+        Dictionary with the grid of the raster ('grid'), the block shape ('block_shape') and the
+        hex digests as a list of rows of blocks ('hashes')
+    """
+    block_height, block_width = dataset.block_shapes[0]
+    block_height *= math.ceil(HASH_BLOCK_MIN_ROWS / block_height)
+    block_width = min(block_width, dataset.width)
+    grid = repr((dataset.crs.to_wkt(), tuple(dataset.transform)[:6], dataset.width, dataset.height, dataset.count,
+                 tuple(dataset.dtypes), (block_height, block_width)))
+
+    hashes = []
+    for row_off in range(0, dataset.height, block_height):
+        height = min(block_height, dataset.height - row_off)
+        hashers = [hashlib.sha1() for _ in range(0, dataset.width, block_width)]
+        for band in dataset.indexes:
+            strip = dataset.read(band, window=Window(0, row_off, dataset.width, height))
+            for hasher, col_off in zip(hashers, range(0, dataset.width, block_width)):
+                hasher.update(np.ascontiguousarray(strip[:, col_off:col_off + block_width]).tobytes())
+        hashes.append([hasher.hexdigest() for hasher in hashers])
+    return {'grid': grid, 'block_shape': [block_height, block_width], 'hashes': hashes}
+
+
+def changed_block_windows(previous, current):
+    """
+    Windows of the blocks whose hash differs between two block_hashes results.
+
+    Returns:
+        List of rasterio windows (empty when nothing changed), or None when the grids differ and
+        the blocks cannot be compared
+    """
+    if previous is None or previous['grid'] != current['grid']:
+        return None
+    block_height, block_width = current['block_shape']
+    return [Window(col * block_width, row * block_height, block_width, block_height)
+            for row, (old_row, new_row) in enumerate(zip(previous['hashes'], current['hashes']))
+            for col, (old, new) in enumerate(zip(old_row, new_row)) if old != new]
+
+
+class BlockHashStore:
+    """
+    Block hashes of the rasters last merged into a mesh, one JSON file per indicator.
+
+    Entries are keyed by the mesh hash and the indicator name, so each output mesh keeps track of
+    the version of every raster its columns were computed from.
+    """
+
+    def __init__(self, cache_dir, mesh_hash):
+        self.cache_dir = cache_dir
+        self.mesh_hash = mesh_hash
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, name):
+        name_hash = hashlib.sha1(name.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'blocks_{self.mesh_hash}_{name_hash}.json')
+
+    def get(self, name):
+        path = self.path(name)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    def put(self, name, hashes):
+        # Written to a temporary file first so that an interrupted run never leaves a partial entry
+        path = self.path(name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(hashes, file)
+        os.replace(tmp_path, path)
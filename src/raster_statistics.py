@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Example: python3 raster_statistics.py --indicator_files_mask=local_data/rasters/*.tif --percentiles=2,98 --output_folder=output/raster_statistics --output_file=input_values_rasters.csv --debug
+# The output file can be passed directly to fix_legends_from_csv.py (--to_fix)
+
+# Geospatial data processing libraries
+import rasterio as rio
+
+# Numerical processing library
+import numpy as np
+
+# Data manipulation libraries
+import pandas as pd
+
+# System utility libraries
+import os
+import glob
+import argparse
+import time
+from contextlib import ExitStack
+
+# My utility functions
+from utilities import create_folder_if_not_exists
+from zonal_statistics import apply_scales, budget_windows, declares_nodata, read_values
+
+# Ignore warnings
+import warnings
+warnings.filterwarnings("ignore")
+
+# Smallest overview, in pixels, used to estimate the percentiles without the --exact pass
+OVERVIEW_MIN_PIXELS = 1_000_000
+# Bins of the histogram that locates each percentile in the exact pass
+QUANTILE_BINS = 4096
+
+
+def indicator_id_from_path(path):
+    """Indicator code of a raster: the file name up to the first '-', as in the XLSX legend inputs."""
+    return os.path.splitext(os.path.basename(path))[0].split('-')[0]
+
+
+def valid_band_values(indicator, band, window=None):
+    """Valid values (see zonal_statistics.read_values) of one band in a window, scaled, as a flat array."""
+    values, valid = read_values(indicator, [band], window)
+    return apply_scales(indicator, [band], values[valid][None, :])[0]
+
+
+def internal_min_max(indicator, band):
+    """
+    Minimum and maximum stored by GDAL with the raster (internal tags or .aux.xml), if exact.
+
+    They are used only when the raster declares its nodata, since GDAL would otherwise count the
+    negative values that the merge scripts treat as missing data.
+
+    Returns:
+        Tuple (minimum, maximum) or None when the raster has no exact statistics
+    """
+    tags = indicator.tags(band)
+    if not declares_nodata(indicator) or tags.get('STATISTICS_APPROXIMATE', 'NO').upper() == 'YES':
+        return None
+    if 'STATISTICS_MINIMUM' not in tags or 'STATISTICS_MAXIMUM' not in tags:
+        return None
+    scale, offset = indicator.scales[band - 1], indicator.offsets[band - 1]
+    limits = sorted(float(tags[name]) * scale + offset for name in ('STATISTICS_MINIMUM', 'STATISTICS_MAXIMUM'))
+    return limits[0], limits[1]
+
+
+def overview_values(indicator, band):
+    """
+    Valid values of the coarsest overview with at least OVERVIEW_MIN_PIXELS pixels.
+
+    Only overviews built by sampling (nearest or mode) are used: averaged overviews smooth the
+    values and pull the tails of the distribution towards the mean.
+
+    Returns:
+        Flat array of values, or None when the raster has no suitable overview
+    """
+    factors = indicator.overviews(band)
+    levels = [level for level, factor in enumerate(factors)
+              if (indicator.width // factor) * (indicator.height // factor) >= OVERVIEW_MIN_PIXELS]
+    if not levels:
+        return None
+    with rio.open(indicator.name, overview_level=levels[-1]) as overview:
+        if overview.tags(band).get('RESAMPLING', 'NEAREST').upper() not in ('NEAREST', 'MODE'):
+            return None
+        return valid_band_values(overview, band)
+
+
+def overview_percentiles(indicators, band, percentiles):
+    """
+    Estimate the percentiles from the pooled overview values of the rasters (see overview_values).
+
+    Returns:
+        List of values, one per percentile, or None when a raster has no suitable overview
+    """
+    values = []
+    for indicator in indicators:
+        indicator_values = overview_values(indicator, band)
+        if indicator_values is None:
+            return None
+        values.append(indicator_values)
+    values = np.concatenate(values)
+    if len(values) == 0:
+        return [np.nan] * len(percentiles)
+    return list(np.percentile(values, percentiles))
+
+
+def exact_statistics(indicators, band, percentiles, memory_budget=None, limits=None):
+    """
+    Exact minimum, maximum and percentiles of a band over the pooled pixels of the rasters.
+
+    Each raster is streamed in windows. A first pass finds the minimum and maximum (skipped when
+    already known), a second one builds a histogram of QUANTILE_BINS bins to locate the bin of each
+    needed rank, and a third one keeps only the values of those bins, so the memory does not grow
+    with the rasters. The percentiles use linear interpolation, like numpy.percentile and the pNN
+    statistics of the merge scripts.
+
+    Args:
+        indicators: Open rasterio datasets, the scenario and year variants of one indicator
+        band: Band to read
+        percentiles: Percentiles (0 to 100) to compute
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads each raster at once
+        limits: Known (minimum, maximum) of the band over all the rasters
+
+    Returns:
+        Tuple (minimum, maximum, list of percentile values). NaN when the band has no valid pixel
+    """
+    windows = [(indicator, window) for indicator in indicators for window in budget_windows(indicator, memory_budget)]
+    if limits is None:
+        minimum, maximum = np.inf, -np.inf
+        for indicator, window in windows:
+            values = valid_band_values(indicator, band, window)
+            if len(values):
+                minimum, maximum = min(minimum, values.min()), max(maximum, values.max())
+        if minimum > maximum:
+            return np.nan, np.nan, [np.nan] * len(percentiles)
+        limits = (float(minimum), float(maximum))
+    minimum, maximum = limits
+    if not len(percentiles):
+        return minimum, maximum, []
+    if minimum == maximum:
+        return minimum, maximum, [minimum] * len(percentiles)
+
+    def bin_of(values):
+        scaled = (values - minimum) / (maximum - minimum) * QUANTILE_BINS
+        return np.clip(scaled.astype(np.int64), 0, QUANTILE_BINS - 1)
+
+    histogram = np.zeros(QUANTILE_BINS, dtype=np.int64)
+    for indicator, window in windows:
+        histogram += np.bincount(bin_of(valid_band_values(indicator, band, window)), minlength=QUANTILE_BINS)
+    count = int(histogram.sum())
+    if count == 0:
+        return np.nan, np.nan, [np.nan] * len(percentiles)
+
+    # Ranks around each percentile position and the bins holding them
+    positions = np.asarray(percentiles, dtype=np.float64) / 100 * (count - 1)
+    ranks = np.unique(np.concatenate([np.floor(positions), np.ceil(positions)]).astype(np.int64))
+    cumulative = np.cumsum(histogram)
+    rank_bins = np.searchsorted(cumulative, ranks, side='right')
+    needed = np.unique(rank_bins)
+
+    kept = {bin_index: [] for bin_index in needed}
+    for indicator, window in windows:
+        values = valid_band_values(indicator, band, window)
+        bins = bin_of(values)
+        selected = np.isin(bins, needed)
+        values, bins = values[selected], bins[selected]
+        for bin_index in np.unique(bins):
+            kept[bin_index].append(values[bins == bin_index])
+
+    rank_values = {}
+    for rank, bin_index in zip(ranks, rank_bins):
+        bin_values = np.sort(np.concatenate(kept[bin_index]))
+        first_rank = cumulative[bin_index] - histogram[bin_index]
+        rank_values[rank] = float(bin_values[rank - first_rank])
+
+    results = []
+    for position in positions:
+        low, high = rank_values[int(np.floor(position))], rank_values[int(np.ceil(position))]
+        results.append(low + (high - low) * (position - np.floor(position)))
+    return minimum, maximum, results
+
+
+def raster_statistics(paths, band=1, percentiles=(), memory_budget=None, exact=False):
+    """
+    Minimum, maximum and percentiles of one band over all the rasters of an indicator, with the
+    source of each estimate.
+
+    The rasters (scenario and year variants) are pooled, like the legend columns grouped by
+    generate_legends_from_xlsx.py: the minimum of the minimums, the maximum of the maximums and
+    the percentiles of all their pixels. Exact statistics stored with the rasters are reused for
+    the minimum and maximum, and the percentiles are estimated from overviews when every raster
+    has one, unless exact is set. Everything else is computed with exact streaming passes (see
+    exact_statistics).
+
+    Args:
+        paths: Path of a raster, or list of paths of the rasters of one indicator
+
+    Returns:
+        Dictionary with min, max, one pNN entry per percentile and the method used
+    """
+    paths = [paths] if isinstance(paths, str) else paths
+    with ExitStack() as stack:
+        indicators = [stack.enter_context(rio.open(path)) for path in paths]
+        internal = [internal_min_max(indicator, band) for indicator in indicators]
+        limits = None
+        if all(limit is not None for limit in internal):
+            limits = min(limit[0] for limit in internal), max(limit[1] for limit in internal)
+        estimates = overview_percentiles(indicators, band, percentiles) if len(percentiles) and not exact else None
+        from_overview = estimates is not None
+        if from_overview:
+            minimum, maximum, _ = exact_statistics(indicators, band, [], memory_budget, limits)
+        else:
+            minimum, maximum, estimates = exact_statistics(indicators, band, percentiles, memory_budget, limits)
+
+    method = 'internal statistics' if limits is not None else 'exact min/max'
+    if len(percentiles):
+        method += ', overview percentiles' if from_overview else ', exact percentiles'
+    result = {'min': minimum, 'max': maximum, 'method': method}
+    for percentile, value in zip(percentiles, estimates):
+        result[f'p{percentile:g}'] = value
+    return result
+
+
+def main(args):
+    indicator_files_mask = args.indicator_files_mask
+    output_folder_path = args.output_folder
+    output_file = args.output_file
+    debug = args.debug
+    percentiles = [float(value) for value in args.percentiles.split(',')] if args.percentiles else []
+    range_percentiles = [float(value) for value in args.range_percentiles.split(',')] \
+        if args.range_percentiles else []
+
+    if debug:
+        print("Passed arguments:")
+        print("Indicator files mask:", indicator_files_mask)
+        print("Band:", args.band)
+        print("Percentiles:", percentiles)
+        print("Range percentiles:", range_percentiles)
+        print("Exact:", args.exact)
+        print("Memory budget:", args.memory_budget)
+        print("Output folder:", output_folder_path)
+        print("Output file:", output_file)
+
+    indicator_tifs = sorted(glob.glob(indicator_files_mask, recursive=True))
+    print(f'Found {len(indicator_tifs)} raster files')
+    create_folder_if_not_exists(output_folder_path)
+
+    # Scenario and year variants of an indicator (123-2030.tif, 123-2050.tif) share one row
+    indicator_groups = {}
+    for indicator_file_path in indicator_tifs:
+        indicator_groups.setdefault(indicator_id_from_path(indicator_file_path), []).append(indicator_file_path)
+    print(f'Found {len(indicator_groups)} indicators')
+
+    requested = sorted(set(percentiles) | set(range_percentiles))
+    rows = []
+    for indicator_id, indicator_file_paths in indicator_groups.items():
+        statistics = raster_statistics(indicator_file_paths, args.band, requested, args.memory_budget, args.exact)
+        if debug:
+            print(f"{indicator_id} {indicator_file_paths}: {statistics}")
+        method = statistics.pop('method')
+        row = {'indicator_id': indicator_id, **statistics}
+        if range_percentiles:
+            # The legend range spans the given percentiles instead of the extreme values
+            row['min'], row['max'] = (statistics[f'p{percentile:g}'] for percentile in range_percentiles)
+        row = {key: value for key, value in row.items()
+               if not key.startswith('p') or float(key[1:]) in percentiles}
+        rows.append(row)
+        print(f"{indicator_id} ({len(indicator_file_paths)} files): min={row['min']} max={row['max']} ({method})")
+
+    # Same layout as the input of fix_legends_from_csv.py: indicator_id|min|max, then the percentiles
+    df_values = pd.DataFrame(rows, columns=['indicator_id', 'min', 'max'] + [f'p{value:g}' for value in percentiles])
+    df_values.to_csv(os.path.join(output_folder_path, output_file), sep='|', index=False)
+    print(f"File saved in: {os.path.join(output_folder_path, output_file)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--indicator_files_mask", required=True,
+                        help="Path to the indicator files mask. The glob function will be used to find the indicator files. Example: directory/*.tif")
+
+    parser.add_argument("--output_folder", required=True,
+                        help="Path to the directory that will be used to save the generated file.")
+
+    parser.add_argument("--output_file", default='input_values_rasters.csv',
+                        help="Name of the output file, in the indicator_id|min|max format read by fix_legends_from_csv.py.")
+
+    parser.add_argument("--band", type=int, default=1,
+                        help="Band of the rasters to summarize.")
+
+    parser.add_argument("--percentiles", default=None,
+                        help="Comma separated percentiles (0 to 100) written as pNN columns after min and max. Example: 2,50,98")
+
+    parser.add_argument("--range_percentiles", default=None,
+                        help="Two comma separated percentiles written in the min and max columns instead of the extreme values, so outliers do not stretch the legends. Example: 2,98")
+
+    parser.add_argument("--exact", action="store_true",
+                        help="Compute the percentiles with exact streaming passes even when the raster has overviews.")
+
+    parser.add_argument("--memory_budget", type=float, default=None,
+                        help="Stream the rasters in windows aligned to their native blocks, using at most this many megabytes per window. By default each band is read at once.")
+
+    parser.add_argument("--debug", action="store_true",
+                        help="Activate debug mode.")
+
+    args = parser.parse_args()
+
+    if args.range_percentiles and len(args.range_percentiles.split(',')) != 2:
+        parser.error("--range_percentiles takes two percentiles, for the min and max columns")
+    for value in ','.join(filter(None, [args.percentiles, args.range_percentiles])).split(','):
+        if value and not 0 <= float(value) <= 100:
+            parser.error(f"Percentiles must be between 0 and 100: {value}")
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        parser.error("--memory_budget must be positive")
+
+    start_time = time.time()
+    main(args)
+    final_time = time.time()
+    total_time = (final_time - start_time) / 60
+    print(f"Total time: {total_time} minutes")
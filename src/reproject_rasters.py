@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Example: python3 reproject_rasters.py --input_mask=local_data/rasters/*.tif --target_epsg=5880 --suffix=_5880 --output_dir=output/new_rasters --workers=4 --warp_mem_limit=512
+
+import os
+import json
+import argparse
+import glob
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import rasterio as rio
+import rasterio.shutil
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from tqdm import tqdm
+
+from raster_cache import file_hash
+from utilities import missing_fill_value
+
+
+def output_is_current(output_path, record):
+    """True when the output exists and its sidecar records the same source hash and settings."""
+    record_path = output_path + '.source.json'
+    if not (os.path.exists(output_path) and os.path.exists(record_path)):
+        return False
+    with open(record_path) as file:
+        return json.load(file) == record
+
+
+def reproject_raster_to_cog(input_path, output_path, target_epsg, resampling='nearest', warp_mem_limit=256,
+                            threads='ALL_CPUS', compress='DEFLATE'):
+    """
+    Warp a raster to the target EPSG and write it as a tiled Cloud Optimized GeoTIFF with overviews.
+
+    The warp runs through a GDAL warped VRT with multithreaded warping and the given memory limit,
+    and is streamed straight into the COG driver, so no intermediate GeoTIFF is written. A sidecar
+    '<output>.source.json' records the source hash and settings, so unchanged files are skipped.
+
+    When the source declares no nodata, the corners outside its footprint are filled with
+    utilities.missing_fill_value, or masked with an alpha band for unsigned types, instead of
+    being written as valid zeros.
+
+    Returns:
+        'skipped' when the output already matches the source, otherwise 'reprojected'
+    """
+    record = {'source_sha1': file_hash(input_path), 'target_epsg': target_epsg, 'resampling': resampling,
+              'compress': compress, 'outside_footprint': 'missing'}
+    if output_is_current(output_path, record):
+        return 'skipped'
+
+    tmp_output_path = output_path + '.tmp.tif'
+    with rio.Env(GDAL_NUM_THREADS=threads):
+        with rio.open(input_path) as src:
+            target_crs = CRS.from_epsg(target_epsg)
+            cog_options = dict(driver='COG', COMPRESS=compress, BLOCKSIZE=512, OVERVIEWS='AUTO', BIGTIFF='IF_SAFER',
+                               NUM_THREADS=threads, RESAMPLING=resampling.upper())
+            if src.crs == target_crs:
+                rasterio.shutil.copy(src, tmp_output_path, **cog_options)
+            else:
+                fill = missing_fill_value(src.dtypes[0]) if src.nodata is None else None
+                with WarpedVRT(src, crs=target_crs, resampling=Resampling[resampling],
+                               warp_mem_limit=warp_mem_limit, add_alpha=src.nodata is None and fill is None,
+                               NUM_THREADS=threads) as vrt:
+                    if fill is None:
+                        rasterio.shutil.copy(vrt, tmp_output_path, **cog_options)
+                    else:
+                        # WarpedVRT always initializes the output to 0 without a nodata value. The fill is
+                        # set in a VRT file instead, without declaring it as nodata
+                        tmp_vrt_path = output_path + '.tmp.vrt'
+                        rasterio.shutil.copy(vrt, tmp_vrt_path, driver='VRT')
+                        with open(tmp_vrt_path) as file:
+                            document = file.read()
+                        with open(tmp_vrt_path, 'w') as file:
+                            file.write(re.sub(r'<Option name="INIT_DEST">[^<]*</Option>',
+                                              f'<Option name="INIT_DEST">{fill}</Option>', document))
+                        try:
+                            with rio.open(tmp_vrt_path) as filled:
+                                rasterio.shutil.copy(filled, tmp_output_path, **cog_options)
+                        finally:
+                            os.remove(tmp_vrt_path)
+
+    # Moved into place only when complete, so an interrupted run never leaves a partial raster
+    os.replace(tmp_output_path, output_path)
+    with open(output_path + '.source.json', 'w') as file:
+        json.dump(record, file)
+    return 'reprojected'
+
+
+def reproject_rasters(input_mask, target_epsg, suffix, output_dir=None, workers=1, resampling='nearest',
+                      warp_mem_limit=256, threads='ALL_CPUS'):
+    if output_dir is None:
+        output_dir = os.path.dirname(input_mask)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+
+    rasters = [f for f in glob.glob(input_mask, recursive=True) if f.lower().endswith(('.tif', '.tiff'))]
+
+    jobs = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for raster in rasters:
+            filename, ext = os.path.splitext(os.path.basename(raster))
+            new_filename = f"{filename}_{suffix}{ext}" if suffix else f"{filename}{ext}"
+            output_path = os.path.join(output_dir, new_filename)
+            if os.path.abspath(output_path) == os.path.abspath(raster):
+                print(f"Skipping {raster}: the output would overwrite the input. Use --suffix or --output_dir.")
+                continue
+            jobs[executor.submit(reproject_raster_to_cog, raster, output_path, target_epsg, resampling,
+                                 warp_mem_limit, threads)] = raster
+
+        for job in tqdm(as_completed(jobs), total=len(jobs), desc="Reprojecting rasters"):
+            raster = jobs[job]
+            try:
+                print(f"\n{raster}: {job.result()}")
+            except Exception as ex:
+                print(f"\nERROR in {raster}: {ex}")
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--input_mask", required=True,
+                        help="File mask to search for rasters (.tif, including subdirectories).")
+    parser.add_argument("--target_epsg", type=int, required=True,
+                        help="Target EPSG code for reprojection.")
+    parser.add_argument("--suffix", required=False,
+                        help="Suffix to be added to the output raster names.")
+    parser.add_argument("--output_dir", required=False,
+                        help="Output directory for the reprojected rasters.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of rasters reprojected in parallel, each in its own process.")
+    parser.add_argument("--threads", default='ALL_CPUS',
+                        help="GDAL threads used by each warp and by the COG compression and overviews. A number or ALL_CPUS.")
+    parser.add_argument("--warp_mem_limit", type=int, default=256,
+                        help="Working memory of each warp, in megabytes.")
+    parser.add_argument("--resampling", choices=['nearest', 'bilinear', 'cubic', 'average', 'mode'], default='nearest',
+                        help="Resampling method of the warp and of the overviews. Use nearest or mode for classified rasters.")
+
+    args = parser.parse_args()
+
+    reproject_rasters(args.input_mask, args.target_epsg, args.suffix, args.output_dir, args.workers,
+                      args.resampling, args.warp_mem_limit, args.threads)
+
+if __name__ == "__main__":
+    start_time = time.time()
+    main()
+    final_time = time.time()
+    total_time = (final_time - start_time) / 60
+    print(f"Total time: {total_time} minutes")
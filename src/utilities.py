@@ -4,6 +4,7 @@
 import math
 import os
 import warnings
+from xml.sax.saxutils import escape
 from decimal import Decimal, InvalidOperation
 from typing import List, Tuple, Optional
 
@@ -15,9 +16,12 @@ import pandas as pd
 import rasterio as rio
 import rtree as rt
 import seaborn as sns
+import shapely
 from matplotlib.ticker import PercentFormatter
 from pyproj import CRS
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio import features
+from rasterio.dtypes import _gdal_typename
+from rasterio.warp import calculate_default_transform, reproject, transform_geom, Resampling
 from shapely.geometry import MultiPolygon, Polygon
 from sklearn.metrics import confusion_matrix
 
@@ -325,6 +329,60 @@ def find_indicator_column(patterns, indicator: pd.DataFrame) -> str:
                 return col_test
     return None
 
+def grouped_weighted_average(keys, values, weights) -> pd.Series:
+    """
+    Weighted average of the values of each key, with columnar grouped sums.
+
+    value*weight and weight are summed per key with np.bincount, in row order, and then divided,
+    which gives the same result as sum(value * weight) / sum(weight) evaluated group by group:
+    a NaN value makes its group NaN and rows without a key are ignored, like in DataFrame.groupby.
+    A group with zero total weight gets NaN, where the Python division raised ZeroDivisionError.
+
+    Args:
+        keys: Group key of each row
+        values: Value of each row
+        weights: Weight of each row
+
+    Returns:
+        Series with the weighted average of each key, indexed by the sorted keys
+    """
+    codes, uniques = pd.factorize(pd.Series(keys), sort=True)
+    present = codes >= 0
+    codes = codes[present]
+    values = np.asarray(values, dtype=np.float64)[present]
+    weights = np.asarray(weights, dtype=np.float64)[present]
+    weighted_sum = np.bincount(codes, weights=values * weights, minlength=len(uniques))
+    weight_sum = np.bincount(codes, weights=weights, minlength=len(uniques))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pd.Series(weighted_sum / weight_sum, index=uniques)
+
+
+def pairwise_intersection_area(left, right, chunk_size=1_000_000) -> np.ndarray:
+    """
+    Area of the intersection of each pair (left[i], right[i]), with vectorized shapely operations.
+
+    The pairs are processed in chunks, so millions of pairs never hold all the intersection
+    geometries at once. Chunks with invalid geometries are repaired with make_valid and retried.
+
+    Args:
+        left: Array of shapely geometries
+        right: Array of shapely geometries, of the same length
+        chunk_size: Number of pairs intersected at once
+
+    Returns:
+        Array with the intersection area of each pair
+    """
+    left, right = np.asarray(left, dtype=object), np.asarray(right, dtype=object)
+    areas = np.empty(len(left), dtype=np.float64)
+    for start in range(0, len(left), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        try:
+            overlaps = shapely.intersection(left[chunk], right[chunk])
+        except shapely.errors.GEOSException:
+            overlaps = shapely.intersection(shapely.make_valid(left[chunk]), shapely.make_valid(right[chunk]))
+        areas[chunk] = shapely.area(overlaps)
+    return areas
+
 def create_folder_if_not_exists(folder_path):
     if not os.path.exists(folder_path):
         print("Creating output folder: ", folder_path)
@@ -357,16 +415,46 @@ def plot_mesh_shapefile(mesh):
 
 
 
-def reproject_raster(in_path, out_path, to_crs, debug=False):
+def missing_fill_value(dtype) -> Optional[float]:
+    """
+    Value written where a reprojected or mosaicked raster without nodata has no source pixel.
+
+    It is negative, so it reads as missing data like the negative values of any raster without
+    nodata, and it is not declared as nodata, since that would make the other negative values
+    valid (see zonal_statistics.read_values).
+
+    Returns:
+        -9999, or the minimum of small integer types, or None for unsigned types, which have no
+        negative value and need a mask instead
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return -9999
+    if dtype.kind == 'i':
+        return max(-9999, int(np.iinfo(dtype).min))
+    return None
+
+
+def reproject_raster(in_path, out_path, to_crs, debug=False, transform=None, width=None, height=None):
     # reproject raster to project crs
+    # When transform, width and height are given the raster is warped onto that grid instead of
+    # the default one, so rasters with different CRSs and resolutions end up pixel aligned.
     with rio.open(in_path) as src:
         src_crs = src.crs
         # Imprimir a CRS atual
         if debug:
             print("CRS antigo do indicador:", src_crs)
-        transform, width, height = calculate_default_transform(
-            src_crs, to_crs, src.width, src.height, *src.bounds)
         kwargs = src.meta.copy()
+        fill = None
+        footprint_mask = False
+        if transform is None:
+            transform, width, height = calculate_default_transform(
+                src_crs, to_crs, src.width, src.height, *src.bounds)
+        elif src.nodata is None:
+            # Parts of the grid outside the raster would otherwise read as valid zeros. Unsigned types
+            # have no negative value to fill them with, so a dataset mask marks the raster footprint
+            fill = missing_fill_value(src.dtypes[0])
+            footprint_mask = fill is None
 
         kwargs.update({
             'crs': to_crs,
@@ -383,5 +471,96 @@ def reproject_raster(in_path, out_path, to_crs, debug=False):
                     src_crs=src.crs,
                     dst_transform=transform,
                     dst_crs=to_crs,
+                    dst_nodata=fill,
                     resampling=Resampling.nearest)
+            if footprint_mask:
+                # Pixel centres inside the source bounds, densified to follow the curved edges in the
+                # grid CRS: the pixels that nearest resampling fills
+                footprint = shapely.segmentize(shapely.box(*src.bounds), min(src.res))
+                footprint = transform_geom(src_crs, to_crs, shapely.geometry.mapping(footprint))
+                dst.write_mask(features.rasterize([footprint], out_shape=(height, width), transform=transform,
+                                                  fill=0, default_value=255, dtype='uint8'))
     return(out_path)
+
+
+def build_mosaic_vrt(tile_paths: List[str]) -> str:
+    """
+    Build an in-memory virtual mosaic (VRT) of raster tiles, without writing a mosaic to disk.
+
+    The returned XML can be opened directly with rasterio.open. Windowed reads only touch the
+    tiles that overlap the window. Areas without tiles read as the nodata value of the tiles. When
+    the tiles declare no nodata they read as a negative value, not declared as nodata so that the
+    negative values of the tiles keep meaning missing data, or are masked for unsigned tiles.
+
+    Args:
+        tile_paths: Paths to the tiles. They must share the CRS, resolution, data type and band count
+
+    Returns:
+        VRT document of the mosaic
+    """
+    tiles = []
+    for path in tile_paths:
+        with rio.open(path) as tile:
+            tiles.append((os.path.abspath(path), tile.crs, tile.transform, tile.width, tile.height, tile.count,
+                          tile.dtypes[0], tile.nodata))
+
+    _, crs, transform, _, _, count, dtype, nodata = tiles[0]
+    res_x, res_y = transform.a, -transform.e
+    for path, tile_crs, tile_transform, _, _, tile_count, tile_dtype, _ in tiles:
+        if (tile_crs != crs or tile_count != count or tile_dtype != dtype
+                or not math.isclose(tile_transform.a, res_x) or not math.isclose(-tile_transform.e, res_y)):
+            raise ValueError(f"Tile {path} does not share the CRS, resolution, data type or bands of {tiles[0][0]}")
+
+    left = min(tile[2].c for tile in tiles)
+    top = max(tile[2].f for tile in tiles)
+    right = max(tile[2].c + tile[3] * res_x for tile in tiles)
+    bottom = min(tile[2].f - tile[4] * res_y for tile in tiles)
+    width, height = round((right - left) / res_x), round((top - bottom) / res_y)
+
+    lines = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+             f'  <SRS>{escape(crs.to_wkt())}</SRS>',
+             f'  <GeoTransform>{left!r}, {res_x!r}, 0.0, {top!r}, 0.0, {-res_y!r}</GeoTransform>']
+    fill = missing_fill_value(dtype) if nodata is None else None
+    for band in range(1, count + 1):
+        lines.append(f'  <VRTRasterBand dataType="{_gdal_typename(dtype)}" band="{band}">')
+        if nodata is not None:
+            lines.append(f'    <NoDataValue>{nodata!r}</NoDataValue>')
+        elif fill is not None:
+            # Background covering the whole mosaic: one pixel of the all-valid mask of the first tile,
+            # scaled to a constant negative value, drawn below the tiles
+            lines += ['    <ComplexSource>',
+                      f'      <SourceFilename relativeToVRT="0">{escape(tiles[0][0])}</SourceFilename>',
+                      '      <SourceBand>mask,1</SourceBand>',
+                      '      <SrcRect xOff="0" yOff="0" xSize="1" ySize="1"/>',
+                      f'      <DstRect xOff="0" yOff="0" xSize="{width}" ySize="{height}"/>',
+                      f'      <ScaleOffset>{fill}</ScaleOffset>',
+                      '      <ScaleRatio>0</ScaleRatio>',
+                      '    </ComplexSource>']
+        for path, _, tile_transform, tile_width, tile_height, _, _, tile_nodata in tiles:
+            x_off = round((tile_transform.c - left) / res_x)
+            y_off = round((top - tile_transform.f) / res_y)
+            # Complex sources skip their nodata pixels, so overlapping tile borders do not hide valid values
+            lines += ['    <ComplexSource>',
+                      f'      <SourceFilename relativeToVRT="0">{escape(path)}</SourceFilename>',
+                      f'      <SourceBand>{band}</SourceBand>',
+                      f'      <SrcRect xOff="0" yOff="0" xSize="{tile_width}" ySize="{tile_height}"/>',
+                      f'      <DstRect xOff="{x_off}" yOff="{y_off}" xSize="{tile_width}" ySize="{tile_height}"/>']
+            if tile_nodata is not None:
+                lines.append(f'      <NODATA>{tile_nodata!r}</NODATA>')
+            lines.append('    </ComplexSource>')
+        lines.append('  </VRTRasterBand>')
+    if nodata is None and fill is None:
+        # Unsigned tiles have no negative value to spare: a mask band marks the footprint of the tiles
+        lines += ['  <MaskBand>', '    <VRTRasterBand dataType="Byte">']
+        for path, _, tile_transform, tile_width, tile_height, _, _, _ in tiles:
+            x_off = round((tile_transform.c - left) / res_x)
+            y_off = round((top - tile_transform.f) / res_y)
+            lines += ['      <SimpleSource>',
+                      f'        <SourceFilename relativeToVRT="0">{escape(path)}</SourceFilename>',
+                      '        <SourceBand>mask,1</SourceBand>',
+                      f'        <SrcRect xOff="0" yOff="0" xSize="{tile_width}" ySize="{tile_height}"/>',
+                      f'        <DstRect xOff="{x_off}" yOff="{y_off}" xSize="{tile_width}" ySize="{tile_height}"/>',
+                      '      </SimpleSource>']
+        lines += ['    </VRTRasterBand>', '  </MaskBand>']
+    lines.append('</VRTDataset>')
+    return '\n'.join(lines)
@@ -0,0 +1,1306 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Zonal statistics engines used by merge_rasters_mesh.py.
+
+# System utility libraries
+import hashlib
+import math
+import os
+import re
+
+# Numerical processing library
+import numpy as np
+import cv2
+
+# Geospatial data processing libraries
+import geopandas as gpd
+import rasterio as rio
+import shapely
+from pyproj import CRS
+from rasterio import features
+from rasterio.enums import MaskFlags
+from rasterio.windows import Window
+
+# Useful libraries
+from progress.bar import Bar
+
+# Optional JIT compiler used by the numba engine
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# My utility functions
+from raster_cache import WindowedRaster
+from utilities import convert_multi_to_single_polygon
+
+
+def overlap_layers(geometries, all_touched=False) -> np.ndarray:
+    """
+    Split the geometries into layers where no two geometries of the same layer share interior.
+
+    Tessellations (municipalities, hexagon grids) end up in a single layer. Buffered line
+    meshes overlap at their joints and usually need two or three layers.
+
+    Args:
+        geometries: Array of shapely geometries
+        all_touched: Also separate the geometries that only touch, since the pixels along a shared
+            border are touched by both of them. Tessellations then need a few layers
+
+    Returns:
+        Array with the layer number of each geometry
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    layers = np.zeros(len(geometries), dtype=np.int32)
+    if len(geometries) == 0:
+        return layers
+
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries, predicate='intersects')
+    candidates = left < right
+    left, right = left[candidates], right[candidates]
+    if not all_touched:
+        # Neighbours that only share a border can be burned in the same pass
+        overlapping = ~shapely.touches(geometries[left], geometries[right])
+        left, right = left[overlapping], right[overlapping]
+    if len(left) == 0:
+        return layers
+
+    # Greedy colouring, only visiting the geometries that actually overlap
+    neighbours = {}
+    for a, b in zip(left.tolist(), right.tolist()):
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+    for idx in sorted(neighbours):
+        used = {layers[n] for n in neighbours[idx] if n < idx}
+        layer = 0
+        while layer in used:
+            layer += 1
+        layers[idx] = layer
+    return layers
+
+
+def polygon_membership(geometries, transform, shape, all_touched=False):
+    """
+    Burn every polygon ID into a label raster and return the pixel/polygon membership.
+
+    Args:
+        geometries: Array of shapely geometries, in the raster CRS
+        transform: Affine transform of the raster
+        shape: (rows, cols) of the raster
+        all_touched: Include every pixel touched by a polygon instead of the pixels whose centre is inside it
+
+    Returns:
+        Tuple (pixels, ids): flat pixel indices sorted in row-major order and the polygon index of each one
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    valid = np.flatnonzero(~(shapely.is_missing(geometries) | shapely.is_empty(geometries)))
+    layers = overlap_layers(geometries[valid], all_touched)
+
+    pixel_chunks, id_chunks = [], []
+    for layer in range(int(layers.max()) + 1 if len(layers) else 0):
+        ids = valid[layers == layer]
+        labels = features.rasterize(zip(geometries[ids], ids + 1), out_shape=shape, transform=transform,
+                                    fill=0, all_touched=all_touched, dtype='int32')
+        pixels = np.flatnonzero(labels)
+        pixel_chunks.append(pixels)
+        id_chunks.append(labels.ravel()[pixels] - 1)
+
+    if not pixel_chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+    pixels = np.concatenate(pixel_chunks).astype(np.int64)
+    ids = np.concatenate(id_chunks).astype(np.int32)
+    if len(pixel_chunks) > 1:
+        order = np.argsort(pixels, kind='stable')
+        pixels, ids = pixels[order], ids[order]
+    return pixels, ids
+
+
+def _clamped_integral(a, b):
+    """Integral over t in [0, 1] of clamp(a + b * t, 0, 1), element-wise."""
+    def antiderivative(v):
+        return np.where(v <= 0, 0.0, np.where(v >= 1, v - 0.5, v * v / 2))
+
+    flat = np.abs(b) < 1e-12
+    safe_b = np.where(flat, 1.0, b)
+    sloped = (antiderivative(a + b) - antiderivative(a)) / safe_b
+    return np.where(flat, np.clip(a + b / 2, 0, 1), sloped)
+
+
+def coverage_membership(geometries, transform, shape):
+    """
+    Pixel/polygon membership weighted by the exact fraction of each pixel covered by the polygon.
+
+    The polygon edges are moved to pixel coordinates and split at the pixel columns. In each column
+    the covered length of a vertical line is the sum of the clamped heights of the oriented edge
+    pieces crossing it, so the covered area of a pixel is the integral of the pieces crossing its row
+    plus the width of the pieces lying entirely past it. Everything is computed with array operations
+    over all the edges of all the polygons; pixels not crossed by an edge are fully inside or outside
+    and come from the label raster.
+
+    Args:
+        geometries: Array of shapely geometries, in the raster CRS
+        transform: Affine transform of the raster
+        shape: (rows, cols) of the raster
+
+    Returns:
+        Tuple (pixels, ids, weights) sorted in row-major order
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    num_polygons = len(geometries)
+    height, width = shape
+    pixels, ids = polygon_membership(geometries, transform, shape, all_touched=False)
+
+    # Rings of every polygon, oriented so that the covered length below is positive in pixel coordinates
+    inverse = ~transform
+    polygonal = np.isin(shapely.get_type_id(geometries), [3, 6])
+    parts, part_ids = shapely.get_parts(np.where(polygonal, geometries, None), return_index=True)
+    parts = shapely.transform(parts, lambda xy: np.column_stack([
+        inverse.a * xy[:, 0] + inverse.b * xy[:, 1] + inverse.c,
+        inverse.d * xy[:, 0] + inverse.e * xy[:, 1] + inverse.f]))
+    parts = shapely.orient_polygons(parts, exterior_cw=False)
+    rings, ring_parts = shapely.get_rings(parts, return_index=True)
+    coords, coord_rings = shapely.get_coordinates(rings, return_index=True)
+    if len(coords) == 0:
+        return pixels, ids, np.ones(len(pixels))
+
+    # Edges between consecutive vertices of the same ring
+    same_ring = coord_rings[:-1] == coord_rings[1:]
+    x0, y0 = coords[:-1][same_ring, 0], coords[:-1][same_ring, 1]
+    x1, y1 = coords[1:][same_ring, 0], coords[1:][same_ring, 1]
+    edge_ids = part_ids[ring_parts[coord_rings[:-1][same_ring]]]
+
+    # Vertical edges add no covered length, but the pixels they cross are partially covered: their
+    # fraction comes only from the pieces lying past them, so they are listed with a zero integral
+    sloped = x0 != x1
+    vertical_col = np.floor(x0[~sloped]).astype(np.int64)
+    vertical_first_row = np.floor(np.minimum(y0, y1)[~sloped]).astype(np.int64)
+    vertical_num_rows = np.maximum(np.ceil(np.maximum(y0, y1)[~sloped]).astype(np.int64) - vertical_first_row, 1)
+    vertical = np.repeat(np.arange(len(vertical_col)), vertical_num_rows)
+    vertical_row = vertical_first_row[vertical] + (
+        np.arange(len(vertical)) - np.repeat(np.cumsum(vertical_num_rows) - vertical_num_rows, vertical_num_rows))
+    vertical_col = vertical_col[vertical]
+    inside = (vertical_col >= 0) & (vertical_col < width) & (vertical_row >= 0) & (vertical_row < height)
+    vertical_keys = ((edge_ids[~sloped][vertical] * width + vertical_col) * height + vertical_row)[inside]
+    x0, y0, x1, y1, edge_ids = x0[sloped], y0[sloped], x1[sloped], y1[sloped], edge_ids[sloped]
+
+    # Split the edges at the pixel columns, keeping only the columns inside the raster
+    first_col = np.floor(np.minimum(x0, x1)).astype(np.int64)
+    num_cols = np.maximum(np.ceil(np.maximum(x0, x1)).astype(np.int64) - first_col, 1)
+    edge = np.repeat(np.arange(len(x0)), num_cols)
+    col = first_col[edge] + (np.arange(len(edge)) - np.repeat(np.cumsum(num_cols) - num_cols, num_cols))
+    inside = (col >= 0) & (col < width)
+    edge, col = edge[inside], col[inside]
+
+    slope = (y1 - y0)[edge] / (x1 - x0)[edge]
+    forward = x1[edge] > x0[edge]
+    lo = np.maximum(np.minimum(x0, x1)[edge], col)
+    hi = np.minimum(np.maximum(x0, x1)[edge], col + 1)
+    piece_x0, piece_x1 = np.where(forward, lo, hi), np.where(forward, hi, lo)
+    piece_y0 = y0[edge] + slope * (piece_x0 - x0[edge])
+    piece_y1 = y0[edge] + slope * (piece_x1 - x0[edge])
+    piece_dx = piece_x1 - piece_x0
+    piece_ids = edge_ids[edge]
+    group = piece_ids * width + col
+
+    # Rows entirely past a piece get its full (signed) width: suffix sums per (polygon, column)
+    past_row = np.clip(np.floor(np.minimum(piece_y0, piece_y1)).astype(np.int64), 0, height)
+    past_keys = group * (height + 1) + past_row
+    order = np.argsort(past_keys, kind='stable')
+    past_keys = past_keys[order]
+    past_sums = np.concatenate([[0.0], np.cumsum(-piece_dx[order])])
+
+    # Rows crossed by a piece get the integral of its clamped height
+    first_row = np.floor(np.minimum(piece_y0, piece_y1)).astype(np.int64)
+    num_rows = np.maximum(np.ceil(np.maximum(piece_y0, piece_y1)).astype(np.int64) - first_row, 1)
+    piece = np.repeat(np.arange(len(piece_dx)), num_rows)
+    row = first_row[piece] + (np.arange(len(piece)) - np.repeat(np.cumsum(num_rows) - num_rows, num_rows))
+    inside = (row >= 0) & (row < height)
+    piece, row = piece[inside], row[inside]
+    crossed = -piece_dx[piece] * _clamped_integral(piece_y0[piece] - row, (piece_y1 - piece_y0)[piece])
+
+    cell_keys, cell_index = np.unique(np.concatenate([group[piece] * height + row, vertical_keys]),
+                                      return_inverse=True)
+    cell_group, cell_row = np.divmod(cell_keys, height)
+    # bincount of no cell (no edge crosses the window) is an int64 array
+    cell_weights = np.bincount(cell_index, weights=np.concatenate([crossed, np.zeros(len(vertical_keys))]),
+                               minlength=len(cell_keys)).astype(np.float64)
+    start = np.searchsorted(past_keys, cell_group * (height + 1) + cell_row + 1, side='left')
+    stop = np.searchsorted(past_keys, cell_group * (height + 1) + height, side='right')
+    cell_weights += past_sums[stop] - past_sums[start]
+
+    cell_ids, cell_col = np.divmod(cell_group, width)
+    cell_pixels = cell_row * width + cell_col
+
+    # Pixels crossed by an edge take the exact fraction, the others are fully covered
+    interior = ~np.isin(pixels * num_polygons + ids, cell_pixels * num_polygons + cell_ids)
+    pixels = np.concatenate([pixels[interior], cell_pixels])
+    ids = np.concatenate([ids[interior], cell_ids.astype(np.int32)])
+    weights = np.concatenate([np.ones(interior.sum()), np.clip(cell_weights, 0.0, 1.0)])
+
+    # Fractions this small are rounding noise of the window origin, not covered area
+    covered = weights > 1e-9
+    pixels, ids, weights = pixels[covered], ids[covered], weights[covered]
+    order = np.argsort(pixels, kind='stable')
+    return pixels[order], ids[order], weights[order]
+
+
+def geometries_hash(geometries) -> str:
+    """
+    Hash the geometries of a mesh, used to identify it in the membership cache.
+
+    Args:
+        geometries: Array of shapely geometries
+
+    Returns:
+        Hexadecimal SHA-1 digest of the WKB of every geometry
+    """
+    digest = hashlib.sha1()
+    for wkb in shapely.to_wkb(np.asarray(geometries, dtype=object)):
+        digest.update(wkb if wkb is not None else b'')
+    return digest.hexdigest()
+
+
+# Version of the memberships, part of their cache key. Bumped when the membership computed for the
+# same grid changes, so entries written by previous versions are not read (2: all_touched burns
+# touching polygons in separate layers, coverage weights of the pixels crossed by vertical edges)
+MEMBERSHIP_VERSION = 2
+
+
+class MembershipCache:
+    """
+    Polygon to pixel membership of each raster grid, keyed by (mesh hash, CRS, transform, shape).
+
+    Rasters sharing the grid of a previous one (scenario and year variants of an indicator)
+    skip the rasterization and reduce to a gather plus a reduction. Entries are kept in memory
+    and, when a cache folder is given, persisted as .npz files so that later runs reuse them.
+    """
+
+    def __init__(self, mesh_hash, cache_dir=None, keep_in_memory=True):
+        self.mesh_hash = mesh_hash
+        self.cache_dir = cache_dir
+        self.keep_in_memory = keep_in_memory
+        self.memory = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def subset(self, indices):
+        """
+        Cache for a subset of the mesh polygons, sharing the entries kept in memory and the cache folder.
+
+        Args:
+            indices: Indices of the polygons of the subset
+        """
+        subset_hash = hashlib.sha1(self.mesh_hash.encode() + np.asarray(indices, dtype=np.int64).tobytes()).hexdigest()
+        cache = MembershipCache(subset_hash, self.cache_dir, self.keep_in_memory)
+        cache.memory = self.memory
+        return cache
+
+    def key(self, indicator, window, all_touched, coverage_weighted=False) -> str:
+        grid = (self.mesh_hash, indicator.crs.to_wkt(), tuple(indicator.transform)[:6], indicator.shape,
+                (window.col_off, window.row_off, window.width, window.height), all_touched, coverage_weighted,
+                MEMBERSHIP_VERSION)
+        return hashlib.sha1(repr(grid).encode()).hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            return self.memory[key]
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, f'{key}.npz')
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as cached:
+            membership = cached['pixels'], cached['ids'], cached['weights'] if 'weights' in cached else None
+        if self.keep_in_memory:
+            self.memory[key] = membership
+        return membership
+
+    def put(self, key, pixels, ids, weights=None):
+        if self.keep_in_memory:
+            self.memory[key] = pixels, ids, weights
+        if self.cache_dir is not None:
+            # Write to a temporary file first so that concurrent runs never read a partial entry
+            path = os.path.join(self.cache_dir, f'{key}.npz')
+            tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+            arrays = dict(pixels=pixels, ids=ids)
+            if weights is not None:
+                arrays['weights'] = weights
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, path)
+
+
+class ProjectedMeshCache:
+    """
+    Mesh geometries projected to each raster CRS, memoized for the whole run.
+
+    200 rasters in the same CRS cost a single reprojection. When a cache folder is given, the
+    projected geometries are also persisted as GeoParquet and reused by later runs.
+    """
+
+    def __init__(self, mesh_geometry, mesh_hash, cache_dir=None):
+        self.mesh_geometry = mesh_geometry
+        self.mesh_hash = mesh_hash
+        self.cache_dir = cache_dir
+        self.memory = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, crs):
+        """
+        Return the mesh geometries in the given CRS.
+
+        Args:
+            crs: Target CRS (rasterio or pyproj CRS)
+
+        Returns:
+            Array of shapely geometries
+        """
+        wkt = crs.to_wkt()
+        if wkt in self.memory:
+            return self.memory[wkt]
+
+        if CRS.from_user_input(self.mesh_geometry.crs) == CRS.from_user_input(wkt):
+            geometries = self.mesh_geometry.values
+        else:
+            geometries = None
+            path = None
+            if self.cache_dir is not None:
+                crs_hash = hashlib.sha1(wkt.encode()).hexdigest()
+                path = os.path.join(self.cache_dir, f'mesh_{self.mesh_hash}_{crs_hash}.parquet')
+                if os.path.isfile(path):
+                    geometries = gpd.read_parquet(path).geometry.values
+            if geometries is None:
+                geometries = self.mesh_geometry.to_crs(wkt).values
+                if path is not None:
+                    tmp_path = f'{path}.{os.getpid()}.tmp'
+                    gpd.GeoDataFrame(geometry=geometries).to_parquet(tmp_path)
+                    os.replace(tmp_path, path)
+
+        self.memory[wkt] = geometries
+        return geometries
+
+
+# Statistics that can be requested besides the percentiles 'pNN' (p90, p25, ...)
+STATISTICS = ['mean', 'max', 'min', 'std', 'count', 'median']
+
+
+def parse_statistics(text):
+    """
+    Parse a comma separated list of statistics, such as 'mean,max,p90'.
+
+    Raises:
+        ValueError: If a statistic is unknown
+    """
+    statistics = [name.strip() for name in text.split(',') if name.strip()]
+    for name in statistics:
+        if name not in STATISTICS and not re.fullmatch(r'p\d{1,2}', name):
+            raise ValueError(f"Unknown statistic: {name}. Use {', '.join(STATISTICS)} or pNN (p90, p25, ...)")
+    if not statistics:
+        raise ValueError("At least one statistic must be given")
+    return statistics
+
+
+def statistic_quantile(name):
+    """Quantile in [0, 1] of a median/percentile statistic, or None for the other statistics."""
+    if name == 'median':
+        return 0.5
+    if re.fullmatch(r'p\d{1,2}', name):
+        return int(name[1:]) / 100
+    return None
+
+
+class ZonalAccumulator:
+    """
+    Per-polygon partial aggregates that can be updated block by block.
+
+    Count, sums, minimum and maximum are associative and the variance is merged with Chan's
+    parallel algorithm, so the result does not depend on how the raster was split into windows.
+    Medians and percentiles are not decomposable: when requested, the valid pixel values of
+    every polygon are kept until the end.
+    """
+
+    def __init__(self, num_polygons, keep_values=False):
+        self.num_polygons = num_polygons
+        self.count = np.zeros(num_polygons, dtype=np.int64)
+        self.weight = np.zeros(num_polygons, dtype=np.float64)
+        self.total = np.zeros(num_polygons, dtype=np.float64)
+        self.m2 = np.zeros(num_polygons, dtype=np.float64)
+        self.minimum = np.full(num_polygons, np.inf)
+        self.maximum = np.full(num_polygons, -np.inf)
+        self.keep_values = keep_values
+        self.kept = []
+        self.weighted = False
+
+    def update(self, ids, values, weights=None, valid=None):
+        """
+        Add the pixel values of a window to the aggregates.
+
+        Args:
+            ids: Polygon index of each pixel value
+            values: Pixel values
+            weights: Optional covered fraction of each pixel. By default every pixel weighs 1.0
+            valid: Optional mask of the usable values (see read_values). By default negative values
+                and NaN are left out
+        """
+        if valid is None:
+            valid = values >= 0
+        values, ids = values[valid].astype(np.float64), ids[valid]
+        self.weighted = self.weighted or weights is not None
+        weights = np.ones(len(values)) if weights is None else weights[valid]
+
+        count = np.bincount(ids, minlength=self.num_polygons)
+        weight = np.bincount(ids, weights=weights, minlength=self.num_polygons)
+        total = np.bincount(ids, weights=values * weights, minlength=self.num_polygons)
+        mean = np.divide(total, weight, out=np.zeros(self.num_polygons), where=weight > 0)
+        m2 = np.bincount(ids, weights=weights * (values - mean[ids]) ** 2, minlength=self.num_polygons)
+
+        # Merge the window variance into the running one
+        previous_mean = np.divide(self.total, self.weight, out=np.zeros(self.num_polygons), where=self.weight > 0)
+        combined = self.weight + weight
+        delta = mean - previous_mean
+        self.m2 += m2 + np.divide(delta ** 2 * self.weight * weight, combined,
+                                  out=np.zeros(self.num_polygons), where=combined > 0)
+
+        self.count += count
+        self.weight += weight
+        self.total += total
+        np.minimum.at(self.minimum, ids, values)
+        np.maximum.at(self.maximum, ids, values)
+        if self.keep_values:
+            self.kept.append((ids, values, weights))
+
+    def statistic(self, name):
+        """
+        Value of a statistic for each polygon. Polygons without valid pixels get -1.0 (0 for count).
+
+        Args:
+            name: One of STATISTICS or a percentile 'pNN'
+        """
+        empty = self.count == 0
+        if name == 'count':
+            return self.count.astype(np.float64)
+        if name == 'mean':
+            result = np.divide(self.total, self.weight, out=np.zeros(self.num_polygons), where=~empty)
+        elif name == 'max':
+            result = self.maximum.copy()
+        elif name == 'min':
+            result = self.minimum.copy()
+        elif name == 'std':
+            variance = np.divide(self.m2, self.weight, out=np.zeros(self.num_polygons), where=~empty)
+            result = np.sqrt(np.maximum(variance, 0.0))
+        else:
+            result = self.quantile(statistic_quantile(name))
+        result[empty] = -1.0
+        return result
+
+    def quantile(self, q):
+        """
+        Quantile of the kept values of each polygon.
+
+        Unweighted values are interpolated linearly between the closest ranks, like numpy.percentile.
+        Weighted values (coverage mode) take the first value whose cumulative weight reaches q.
+        """
+        if not self.keep_values:
+            raise ValueError("The accumulator was created without keep_values")
+        result = np.zeros(self.num_polygons)
+        if not self.kept:
+            return result
+
+        ids = np.concatenate([kept[0] for kept in self.kept])
+        values = np.concatenate([kept[1] for kept in self.kept])
+        weights = np.concatenate([kept[2] for kept in self.kept])
+        order = np.lexsort((values, ids))
+        ids, values, weights = ids[order], values[order], weights[order]
+
+        present = np.flatnonzero(self.count > 0)
+        starts = (np.cumsum(self.count) - self.count)[present]
+        if not self.weighted:
+            position = (self.count[present] - 1) * q
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            result[present] = values[starts + lower] + (position - lower) * (values[starts + upper] - values[starts + lower])
+        else:
+            cumulative = np.cumsum(weights)
+            before = np.where(starts > 0, cumulative[np.maximum(starts - 1, 0)], 0.0)
+            # Rounding of the running sum must not move a quantile that falls exactly on a pixel boundary
+            tolerance = 1e-9 * max(cumulative[-1], 1.0)
+            index = np.searchsorted(cumulative, before + q * self.weight[present] - tolerance, side='left')
+            result[present] = values[np.clip(index, starts, starts + self.count[present] - 1)]
+        return result
+
+
+class ClassHistogram:
+    """
+    Per-polygon histograms of classified pixel values, updated block by block.
+
+    Pixels are counted with a single bincount over (polygon, class) pairs. Values that are not
+    one of the classes still count in the polygon total, so the fractions of a polygon only add up
+    to 1 when all its pixels are classified.
+    """
+
+    def __init__(self, num_polygons, class_values):
+        self.num_polygons = num_polygons
+        self.class_values = np.asarray(class_values, dtype=np.float64)
+        self.counts = np.zeros(num_polygons * len(self.class_values), dtype=np.float64)
+        self.total = np.zeros(num_polygons, dtype=np.float64)
+
+    def update(self, ids, values, weights=None, valid=None):
+        """
+        Add the pixel values of a window to the histograms.
+
+        Args:
+            ids: Polygon index of each pixel value
+            values: Pixel values (class codes)
+            weights: Optional covered fraction of each pixel. By default every pixel weighs 1.0
+            valid: Optional mask of the usable values (see read_values). By default negative values
+                and NaN are left out
+        """
+        if valid is None:
+            valid = values >= 0
+        values, ids = values[valid], ids[valid]
+        weights = np.ones(len(values)) if weights is None else weights[valid]
+        self.total += np.bincount(ids, weights=weights, minlength=self.num_polygons)
+
+        order = np.argsort(self.class_values)
+        position = np.clip(np.searchsorted(self.class_values, values, sorter=order), 0, len(order) - 1)
+        classes = order[position]
+        known = self.class_values[classes] == values
+        self.counts += np.bincount(ids[known] * len(self.class_values) + classes[known], weights=weights[known],
+                                   minlength=len(self.counts))
+
+    def fractions(self):
+        """Array (polygons, classes) with the share of each class. Polygons without valid pixels get -1.0."""
+        counts = self.counts.reshape(self.num_polygons, len(self.class_values))
+        result = np.divide(counts, self.total[:, None], out=np.full(counts.shape, -1.0),
+                           where=self.total[:, None] > 0)
+        return result
+
+
+# Bytes held per pixel of a window for the membership: label raster (int32), flat pixel index (int64)
+# and polygon index (int32). Each band adds its pixel value and validity flag, read and gathered.
+MEMBERSHIP_BYTES_PER_PIXEL = 16
+
+
+def compact_dtype(indicator) -> np.dtype:
+    """
+    Most compact dtype that holds the raster values for the statistics.
+
+    float64 rasters are read as float32. Integer rasters keep their native type, so scaled int16
+    rasters stay int16 while in memory and their scale and offset are applied to the gathered
+    pixels only (see apply_scales).
+    """
+    dtype = np.dtype(indicator.dtypes[0])
+    return np.dtype(np.float32) if dtype == np.float64 else dtype
+
+
+def declares_nodata(indicator) -> bool:
+    """True when the raster declares a nodata value, a mask band or an alpha band."""
+    flags = getattr(indicator, 'mask_flag_enums', ())
+    return indicator.nodata is not None or any(band_flags != [MaskFlags.all_valid] for band_flags in flags)
+
+
+def read_values(indicator, bands, window=None):
+    """
+    Read bands in their compact dtype together with the mask of the valid pixels.
+
+    The declared nodata value, mask band or alpha band of the raster marks the invalid pixels.
+    Rasters that declare none of them keep the previous rule: negative values are missing data.
+    NaN is never valid.
+
+    Args:
+        indicator: Open rasterio dataset
+        bands: Bands to read
+        window: Rasterio window to read. None reads the whole raster
+
+    Returns:
+        Tuple (values, valid) of arrays (bands, rows, columns)
+    """
+    dtype = compact_dtype(indicator)
+    if declares_nodata(indicator):
+        data = indicator.read(list(bands), window=window, masked=True, out_dtype=dtype)
+        values, valid = np.ma.getdata(data), ~np.ma.getmaskarray(data)
+        if values.dtype.kind == 'f':
+            valid &= ~np.isnan(values)
+    else:
+        values = indicator.read(list(bands), window=window, out_dtype=dtype)
+        valid = values >= 0
+    return values, valid
+
+
+def apply_scales(indicator, bands, values):
+    """
+    Convert gathered raw values (bands, pixels) to physical values with the band scales and offsets.
+
+    The values are returned untouched when no band is scaled.
+    """
+    scales = getattr(indicator, 'scales', None) or (1.0,) * indicator.count
+    offsets = getattr(indicator, 'offsets', None) or (0.0,) * indicator.count
+    scales = np.array([scales[band - 1] for band in bands], dtype=np.float64)[:, None]
+    offsets = np.array([offsets[band - 1] for band in bands], dtype=np.float64)[:, None]
+    if np.all(scales == 1.0) and np.all(offsets == 0.0):
+        return values
+    return values * scales + offsets
+
+
+def budget_windows(indicator, memory_budget=None, num_bands=1):
+    """
+    Split the raster into windows aligned to its native blocks that fit in the memory budget.
+
+    Args:
+        indicator: Open rasterio dataset
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads the whole raster at once
+        num_bands: Number of bands read for each window
+
+    Returns:
+        List of rasterio windows covering the raster
+    """
+    height, width = indicator.height, indicator.width
+    if memory_budget is None:
+        return [Window(0, 0, width, height)]
+
+    block_height, block_width = indicator.block_shapes[0]
+    bytes_per_pixel = num_bands * 2 * (compact_dtype(indicator).itemsize + 1) + MEMBERSHIP_BYTES_PER_PIXEL
+    max_pixels = max(1, int(memory_budget * 1024 * 1024 // bytes_per_pixel))
+
+    if max_pixels >= width * block_height:
+        # Full-width strips with as many block rows as the budget allows
+        rows = min(height, max_pixels // width // block_height * block_height)
+        cols = width
+    else:
+        # A single block row does not fit: split it in groups of blocks
+        rows = block_height
+        cols = min(width, max(block_width, max_pixels // block_height // block_width * block_width))
+
+    return [Window(col_off, row_off, min(cols, width - col_off), min(rows, height - row_off))
+            for row_off in range(0, height, rows)
+            for col_off in range(0, width, cols)]
+
+
+def label_zonal_statistics(indicator, geometries, all_touched=False, memory_budget=None, membership_cache=None,
+                           coverage_weighted=False, statistics=('mean', 'max'), bands=(1,), class_values=None):
+    """
+    Compute the mean and maximum of every polygon in one vectorized pass over the raster.
+
+    With a memory budget the raster is streamed window by window and only the polygons
+    intersecting each window are burned, so the peak memory no longer grows with the raster size.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely geometries, in the raster CRS
+        all_touched: Include every pixel touched by a polygon
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads the whole raster at once
+        membership_cache: Optional MembershipCache shared by the rasters of a run
+        coverage_weighted: Weight each pixel by the fraction of it covered by the polygon
+        statistics: Statistics to compute, all from the same pass (see STATISTICS)
+        bands: Bands to aggregate. They are read together and share the polygon membership
+        class_values: Optional pixel values of the legend classes. The class fractions of each band
+            are computed in the same pass and returned under (band, 'classes')
+
+    Returns:
+        Dictionary with one array of values per geometry for each (band, statistic), and an array
+        (geometries, classes) for each (band, 'classes') when class_values is given
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    bands = list(bands)
+    keep_values = any(statistic_quantile(name) is not None for name in statistics)
+    accumulators = [ZonalAccumulator(len(geometries), keep_values) for _ in bands]
+    histograms = [ClassHistogram(len(geometries), class_values) for _ in bands] if class_values is not None else []
+    windows = budget_windows(indicator, memory_budget, len(bands))
+    tree = None
+
+    for window in windows:
+        key = (membership_cache.key(indicator, window, all_touched, coverage_weighted)
+               if membership_cache is not None else None)
+        membership = membership_cache.get(key) if key is not None else None
+
+        if membership is None:
+            if len(windows) == 1:
+                candidates = np.arange(len(geometries))
+            else:
+                if tree is None:
+                    tree = shapely.STRtree(geometries)
+                candidates = np.sort(tree.query(shapely.box(*indicator.window_bounds(window))))
+
+            window_transform = indicator.window_transform(window)
+            window_shape = (window.height, window.width)
+            if coverage_weighted:
+                pixels, ids, weights = coverage_membership(geometries[candidates], window_transform, window_shape)
+            else:
+                pixels, ids = polygon_membership(geometries[candidates], window_transform, window_shape, all_touched)
+                weights = None
+            membership = pixels, candidates[ids].astype(np.int32), weights
+            if key is not None:
+                membership_cache.put(key, *membership)
+
+        pixels, ids, weights = membership
+        if len(pixels) == 0:
+            continue
+        pixel_values, pixel_valid = read_values(indicator, bands, window)
+        values = apply_scales(indicator, bands, pixel_values.reshape(len(bands), -1)[:, pixels])
+        valid = pixel_valid.reshape(len(bands), -1)[:, pixels]
+        del pixel_values, pixel_valid
+        for accumulator, band_values, band_valid in zip(accumulators, values, valid):
+            accumulator.update(ids, band_values, weights, band_valid)
+        for histogram, band_values, band_valid in zip(histograms, values, valid):
+            histogram.update(ids, band_values, weights, band_valid)
+
+    results = {(band, name): accumulator.statistic(name)
+               for band, accumulator in zip(bands, accumulators)
+               for name in statistics}
+    for band, histogram in zip(bands, histograms):
+        results[(band, 'classes')] = histogram.fractions()
+    return results
+
+
+def gather_pixels(indicator, rows, cols, bands=(1,), memory_budget=None):
+    """
+    Read the pixel values at the given row/col indices with one fancy index per window.
+
+    Args:
+        indicator: Open rasterio dataset
+        rows: Row index of each pixel
+        cols: Column index of each pixel
+        bands: Bands to read
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads the whole raster at once
+
+    Returns:
+        Array (bands, pixels) with the pixel values. Pixels outside the raster or not valid
+        (see read_values) get NaN
+    """
+    bands = list(bands)
+    values = np.full((len(bands), len(rows)), np.nan, dtype=np.float64)
+
+    for window in budget_windows(indicator, memory_budget, len(bands)):
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        inside = np.flatnonzero((rows >= row_off) & (rows < row_off + window.height) &
+                                (cols >= col_off) & (cols < col_off + window.width))
+        if len(inside) == 0:
+            continue
+        pixel_values, pixel_valid = read_values(indicator, bands, window)
+        window_rows, window_cols = rows[inside] - row_off, cols[inside] - col_off
+        values[:, inside] = np.where(pixel_valid[:, window_rows, window_cols],
+                                     pixel_values[:, window_rows, window_cols], np.nan)
+
+    return apply_scales(indicator, bands, values)
+
+
+def sample_raster(indicator, xs, ys, bands=(1,), memory_budget=None, bilinear=False):
+    """
+    Read the raster values under each (x, y) coordinate.
+
+    Args:
+        indicator: Open rasterio dataset
+        xs: X coordinates, in the raster CRS
+        ys: Y coordinates, in the raster CRS
+        bands: Bands to read
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads the whole raster at once
+        bilinear: Interpolate between the four closest pixel centres instead of taking the pixel under the point
+
+    Returns:
+        Array (bands, coordinates) with the values. Coordinates without valid pixels get NaN
+    """
+    inverse = ~indicator.transform
+    cols = inverse.a * xs + inverse.b * ys + inverse.c
+    rows = inverse.d * xs + inverse.e * ys + inverse.f
+
+    if not bilinear:
+        return gather_pixels(indicator, np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64),
+                             bands, memory_budget)
+
+    # Four closest pixel centres of each coordinate and their bilinear weights
+    top, left = np.floor(rows - 0.5).astype(np.int64), np.floor(cols - 0.5).astype(np.int64)
+    fy, fx = rows - 0.5 - top, cols - 0.5 - left
+    neighbour_rows = np.concatenate([top, top, top + 1, top + 1])
+    neighbour_cols = np.concatenate([left, left + 1, left, left + 1])
+    neighbour_weights = np.concatenate([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx])
+
+    count = len(xs)
+    neighbours = gather_pixels(indicator, neighbour_rows, neighbour_cols, bands, memory_budget)
+    # Invalid neighbours (outside or masked) are left out and the others renormalized
+    valid = ~np.isnan(neighbours)
+    weights = np.where(valid, neighbour_weights, 0.0).reshape(len(neighbours), 4, count)
+    weighted = np.where(valid, neighbours * neighbour_weights, 0.0).reshape(len(neighbours), 4, count)
+    total = weights.sum(axis=1)
+    return np.divide(weighted.sum(axis=1), total, out=np.full(total.shape, np.nan), where=total > 0)
+
+
+def point_zonal_statistics(indicator, geometries, memory_budget=None, statistics=('mean', 'max'), bands=(1,),
+                           bilinear=False):
+    """
+    Compute the value of point features (census points, municipal seats) in one gather.
+
+    All coordinates are converted to row/col indices in one array operation and the pixel values
+    are read with a single fancy index. Multipoint features aggregate their points.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely point geometries, in the raster CRS
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads the whole raster at once
+        statistics: Statistics to compute (see STATISTICS)
+        bands: Bands to aggregate
+        bilinear: Interpolate between the four closest pixel centres
+
+    Returns:
+        Dictionary with one array of values per geometry for each (band, statistic)
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    coords, ids = shapely.get_coordinates(geometries, return_index=True)
+    values = sample_raster(indicator, coords[:, 0], coords[:, 1], bands, memory_budget, bilinear)
+    return aggregate_samples(len(geometries), ids.astype(np.int32), values, statistics, bands)
+
+
+def aggregate_samples(num_features, ids, values, statistics, bands):
+    """
+    Aggregate sampled values (points, line samples) per feature.
+
+    Args:
+        num_features: Number of features in the mesh
+        ids: Feature index of each sample
+        values: Array (bands, samples) with the sampled values
+        statistics: Statistics to compute (see STATISTICS)
+        bands: Bands of the rows of values
+
+    Returns:
+        Dictionary with one array of values per feature for each (band, statistic)
+    """
+    keep_values = any(statistic_quantile(name) is not None for name in statistics)
+    results = {}
+    for band, band_values in zip(bands, values):
+        accumulator = ZonalAccumulator(num_features, keep_values)
+        accumulator.update(ids, band_values, valid=~np.isnan(band_values))
+        for name in statistics:
+            results[(band, name)] = accumulator.statistic(name)
+    return results
+
+
+def line_zonal_statistics(indicator, geometries, memory_budget=None, statistics=('mean', 'max'), bands=(1,)):
+    """
+    Compute statistics of line features (railways, roads) sampling the raster along each line.
+
+    Every part of every line is sampled at pixel spacing, including both ends, with one vectorized
+    interpolation over all segments. Multipart lines keep all their parts and no buffering or
+    polygon filling is needed.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely line geometries, in the raster CRS
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads the whole raster at once
+        statistics: Statistics to compute (see STATISTICS)
+        bands: Bands to aggregate
+
+    Returns:
+        Dictionary with one array of values per geometry for each (band, statistic)
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    bands = list(bands)
+    parts, part_ids = shapely.get_parts(geometries, return_index=True)
+    lengths = shapely.length(parts)
+
+    transform = indicator.transform
+    spacing = min(abs(transform.a), abs(transform.e)) if transform.b == 0 and transform.d == 0 \
+        else np.sqrt(abs(transform.a * transform.e - transform.b * transform.d))
+    num_samples = np.ceil(lengths / spacing).astype(np.int64) + 1
+
+    part = np.repeat(np.arange(len(parts)), num_samples)
+    step = np.arange(len(part)) - np.repeat(np.cumsum(num_samples) - num_samples, num_samples)
+    distances = lengths[part] * step / np.maximum(num_samples[part] - 1, 1)
+    points = shapely.line_interpolate_point(parts[part], distances)
+    coords = shapely.get_coordinates(points)
+
+    values = sample_raster(indicator, coords[:, 0], coords[:, 1], bands, memory_budget)
+    return aggregate_samples(len(geometries), part_ids[part].astype(np.int32), values, statistics, bands)
+
+
+def spatial_tiles(geometries, tile_size):
+    """
+    Split the mesh into square spatial tiles.
+
+    Each geometry belongs to the tile containing its representative point, so geometries that cross
+    tile borders are assigned to exactly one tile.
+
+    Args:
+        geometries: Array of shapely geometries
+        tile_size: Side of the tiles, in units of the geometries CRS
+
+    Returns:
+        List with the array of geometry indices of each non-empty tile
+    """
+    points = shapely.get_coordinates(shapely.point_on_surface(geometries), include_z=False)
+    if len(points) != len(geometries):
+        # Empty geometries have no representative point: they go to the first tile
+        points = np.zeros((len(geometries), 2))
+        present = ~shapely.is_empty(geometries)
+        points[present] = shapely.get_coordinates(shapely.point_on_surface(geometries[present]))
+    cells = np.floor((points - points.min(axis=0)) / tile_size).astype(np.int64)
+    _, tile_ids = np.unique(cells, axis=0, return_inverse=True)
+    tile_ids = tile_ids.ravel()
+    order = np.argsort(tile_ids, kind='stable')
+    return np.split(order, np.flatnonzero(np.diff(tile_ids[order])) + 1)
+
+
+def tile_window(indicator, geometries, halo=1):
+    """
+    Window of the raster covering the geometries of a tile plus a halo of pixels.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely geometries of the tile, in the raster CRS
+        halo: Number of pixels added around the bounds of the geometries
+
+    Returns:
+        Rasterio window, clipped to the raster. At least one pixel, even for tiles outside the raster
+    """
+    bounds = shapely.total_bounds(geometries)
+    if np.isnan(bounds).any():
+        return Window(0, 0, 1, 1)
+    window = indicator.window(*bounds)
+    row_start = min(max(math.floor(window.row_off) - halo, 0), indicator.height - 1)
+    col_start = min(max(math.floor(window.col_off) - halo, 0), indicator.width - 1)
+    row_stop = max(min(math.ceil(window.row_off + window.height) + halo, indicator.height), row_start + 1)
+    col_stop = max(min(math.ceil(window.col_off + window.width) + halo, indicator.width), col_start + 1)
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def window_polygons(indicator, geometries, windows, halo=1):
+    """
+    Indices of the geometries that intersect any of the windows grown by a halo of pixels.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely geometries, in the raster CRS
+        windows: Rasterio windows of the raster
+        halo: Number of pixels added around each window, covering the neighbours read by bilinear sampling
+
+    Returns:
+        Sorted array of geometry indices
+    """
+    if not len(windows):
+        return np.array([], dtype=np.int64)
+    boxes = shapely.box(*np.array([indicator.window_bounds(Window(window.col_off - halo, window.row_off - halo,
+                                                                   window.width + 2 * halo,
+                                                                   window.height + 2 * halo))
+                                   for window in windows]).T)
+    _, indices = shapely.STRtree(geometries).query(boxes, predicate='intersects')
+    return np.unique(indices)
+
+
+def overview_levels(indicator, geometries, tolerance, per_run=False):
+    """
+    Choose the overview level used for each polygon.
+
+    A polygon uses the coarsest overview whose pixel area is at most `tolerance` times the polygon
+    area, so it is still covered by about 1 / tolerance pixels. Large polygons (municipalities,
+    states) then read orders of magnitude fewer pixels.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely geometries, in the raster CRS
+        tolerance: Maximum ratio between the pixel area and the polygon area
+        per_run: Use a single level for every polygon, the one allowed for the smallest polygon
+
+    Returns:
+        Array with the overview level of each polygon, -1 for the full resolution
+    """
+    transform = indicator.transform
+    pixel_area = abs(transform.a * transform.e - transform.b * transform.d)
+    factors = np.array(indicator.overviews(1), dtype=np.float64)
+    allowed = np.nan_to_num(shapely.area(np.asarray(geometries, dtype=object))) * tolerance / pixel_area
+
+    # Overview factors are sorted from the finest to the coarsest
+    levels = np.searchsorted(factors ** 2, allowed, side='right') - 1
+    if per_run and len(levels) > 0:
+        levels[:] = levels.min()
+    return levels
+
+
+def overview_window(overview, bounds):
+    """
+    Limit an overview to the pixels covering the bounds of the raster it replaces.
+
+    The overview is opened from the file name, so it always spans the whole raster. When the
+    raster is a WindowedRaster tile, the tile window is scaled by the overview factor (rounded
+    outwards) so each tile task reads and rasterizes only its part of the overview.
+
+    Args:
+        overview: Open overview dataset
+        bounds: Bounds of the raster, in its CRS
+
+    Returns:
+        The overview itself, or a WindowedRaster over the part of it covering the bounds
+    """
+    window = overview.window(*bounds)
+    col_start, row_start = max(math.floor(window.col_off + 1e-6), 0), max(math.floor(window.row_off + 1e-6), 0)
+    col_stop = min(math.ceil(window.col_off + window.width - 1e-6), overview.width)
+    row_stop = min(math.ceil(window.row_off + window.height - 1e-6), overview.height)
+    if (col_start, row_start, col_stop, row_stop) == (0, 0, overview.width, overview.height):
+        return overview
+    return WindowedRaster(overview, Window(col_start, row_start, max(col_stop - col_start, 0),
+                                           max(row_stop - row_start, 0)))
+
+
+def overview_zonal_statistics(indicator, geometries, levels, membership_cache=None, **options):
+    """
+    Run label_zonal_statistics separately for the polygons of each overview level.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely geometries, in the raster CRS
+        levels: Overview level of each polygon (see overview_levels)
+        membership_cache: Optional MembershipCache shared by the rasters of a run
+        **options: Other arguments of label_zonal_statistics
+
+    Returns:
+        Dictionary with one array of values per geometry for each (band, statistic)
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    results = {}
+    for level in np.unique(levels):
+        indices = np.flatnonzero(levels == level)
+        cache = membership_cache.subset(indices) if membership_cache is not None else None
+        overview = None if level < 0 else rio.open(indicator.name, overview_level=int(level))
+        dataset = indicator if overview is None else overview_window(overview, indicator.bounds)
+        try:
+            level_results = label_zonal_statistics(dataset, geometries[indices], membership_cache=cache, **options)
+        finally:
+            if overview is not None:
+                overview.close()
+        for key, values in level_results.items():
+            results.setdefault(key, np.full((len(geometries),) + values.shape[1:], -1.0))[indices] = values
+    return results
+
+
+def polygon_edges(geometries, transform):
+    """
+    Edges of the rings of every polygon, in pixel coordinates, grouped by polygon.
+
+    Args:
+        geometries: Array of shapely (multi)polygons
+        transform: Affine transform of the raster
+
+    Returns:
+        Tuple (edges, offsets): edges is a (n, 4) array with x0, y0, x1, y1 (column, row) and the
+        edges of polygon i are edges[offsets[i]:offsets[i + 1]]
+    """
+    parts, part_polygon = shapely.get_parts(geometries, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+    inverse = ~transform
+    cols = inverse.a * coords[:, 0] + inverse.b * coords[:, 1] + inverse.c
+    rows = inverse.d * coords[:, 0] + inverse.e * coords[:, 1] + inverse.f
+
+    # Consecutive vertices of the same ring
+    start = np.flatnonzero(coord_ring[:-1] == coord_ring[1:])
+    edges = np.column_stack([cols[start], rows[start], cols[start + 1], rows[start + 1]])
+    edge_polygon = part_polygon[ring_part[coord_ring[start]]]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(edge_polygon, minlength=len(geometries)))])
+    return edges, offsets
+
+
+def _scanline_accumulate(edges, offsets, row_bounds, values, valid, row_off, col_off, count, mean, m2, minimum,
+                         maximum):
+    """
+    Accumulate the window values of every polygon without materializing masks.
+
+    For each pixel row the crossings of the row centre with the polygon edges are sorted, and the
+    valid pixels whose centre lies between consecutive pairs of crossings (even-odd rule) are added
+    to the running count, mean, M2 (Welford), minimum and maximum of the polygon.
+    """
+    height, width = values.shape
+    for polygon in range(len(offsets) - 1):
+        first_row = max(row_bounds[polygon, 0], row_off)
+        last_row = min(row_bounds[polygon, 1], row_off + height)
+        if first_row >= last_row:
+            continue
+
+        # Rows whose centre each edge crosses, half open so that shared vertices are counted once
+        num_crossings = 0
+        for edge in range(offsets[polygon], offsets[polygon + 1]):
+            low = max(int(np.ceil(min(edges[edge, 1], edges[edge, 3]) - 0.5)), first_row)
+            high = min(int(np.ceil(max(edges[edge, 1], edges[edge, 3]) - 0.5)), last_row)
+            num_crossings += max(high - low, 0)
+
+        rows = np.empty(num_crossings, dtype=np.int64)
+        xs = np.empty(num_crossings, dtype=np.float64)
+        k = 0
+        for edge in range(offsets[polygon], offsets[polygon + 1]):
+            x0, y0, x1, y1 = edges[edge, 0], edges[edge, 1], edges[edge, 2], edges[edge, 3]
+            low = max(int(np.ceil(min(y0, y1) - 0.5)), first_row)
+            high = min(int(np.ceil(max(y0, y1) - 0.5)), last_row)
+            for row in range(low, high):
+                rows[k] = row
+                xs[k] = x0 + (row + 0.5 - y0) * (x1 - x0) / (y1 - y0)
+                k += 1
+        if num_crossings == 0:
+            continue
+
+        # Sort the crossings by row, then by column
+        x_min, x_max = xs.min(), xs.max()
+        order = np.argsort((rows - first_row) * (x_max - x_min + 1.0) + (xs - x_min), kind='mergesort')
+
+        for pair in range(0, num_crossings - 1, 2):
+            row = rows[order[pair]] - row_off
+            first_col = max(int(np.ceil(xs[order[pair]] - 0.5)), col_off)
+            last_col = min(int(np.ceil(xs[order[pair + 1]] - 0.5)), col_off + width)
+            for col in range(first_col, last_col):
+                if not valid[row, col - col_off]:
+                    continue
+                value = values[row, col - col_off]
+                count[polygon] += 1
+                delta = value - mean[polygon]
+                mean[polygon] += delta / count[polygon]
+                m2[polygon] += delta * (value - mean[polygon])
+                minimum[polygon] = min(minimum[polygon], value)
+                maximum[polygon] = max(maximum[polygon], value)
+
+
+_scanline_kernel = njit(cache=True, nogil=True)(_scanline_accumulate) if njit is not None else None
+
+# Statistics the scanline kernel accumulates directly
+SCANLINE_STATISTICS = ['mean', 'max', 'min', 'std', 'count']
+
+
+def numba_zonal_statistics(indicator, geometries, memory_budget=None, statistics=('mean', 'max'), bands=(1,)):
+    """
+    Compute the statistics of every polygon with a JIT-compiled scanline rasterizer.
+
+    The pixels of each polygon are visited row by row between its edge crossings and accumulated
+    on the fly, so no mask or label raster is allocated. Pixels are inside a polygon when their
+    centre is, like the label engine without all_touched.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely geometries, in the raster CRS
+        memory_budget: Maximum memory, in megabytes, used by one window. None reads the whole raster at once
+        statistics: Statistics to compute, among SCANLINE_STATISTICS
+        bands: Bands to aggregate
+
+    Returns:
+        Dictionary with one array of values per geometry for each (band, statistic)
+    """
+    if _scanline_kernel is None:
+        raise ImportError("The numba engine requires the numba package (pip install numba)")
+    unsupported = [name for name in statistics if name not in SCANLINE_STATISTICS]
+    if unsupported:
+        raise ValueError(f"The numba engine does not compute {unsupported}. Use the label engine")
+
+    geometries = np.asarray(geometries, dtype=object)
+    num_polygons = len(geometries)
+    edges, offsets = polygon_edges(geometries, indicator.transform)
+
+    # Pixel rows whose centre lies within the vertical extent of each polygon
+    edge_polygon = np.repeat(np.arange(num_polygons), np.diff(offsets))
+    top = np.full(num_polygons, np.inf)
+    bottom = np.full(num_polygons, -np.inf)
+    np.minimum.at(top, edge_polygon, np.minimum(edges[:, 1], edges[:, 3]))
+    np.maximum.at(bottom, edge_polygon, np.maximum(edges[:, 1], edges[:, 3]))
+    row_bounds = np.zeros((num_polygons, 2), dtype=np.int64)
+    present = np.isfinite(top)
+    row_bounds[present, 0] = np.ceil(top[present] - 0.5)
+    row_bounds[present, 1] = np.ceil(bottom[present] - 0.5)
+
+    accumulators = {band: ZonalAccumulator(num_polygons) for band in bands}
+    means = {band: np.zeros(num_polygons) for band in bands}
+    for window in budget_windows(indicator, memory_budget, len(bands)):
+        pixel_values, pixel_valid = read_values(indicator, bands, window)
+        shape = pixel_values.shape
+        pixel_values = apply_scales(indicator, bands, pixel_values.reshape(len(bands), -1)).reshape(shape)
+        for band, band_values, band_valid in zip(bands, pixel_values, pixel_valid):
+            accumulator = accumulators[band]
+            _scanline_kernel(edges, offsets, row_bounds, band_values, band_valid, int(window.row_off),
+                             int(window.col_off), accumulator.count, means[band], accumulator.m2,
+                             accumulator.minimum, accumulator.maximum)
+
+    results = {}
+    for band, accumulator in accumulators.items():
+        accumulator.weight = accumulator.count.astype(np.float64)
+        accumulator.total = means[band] * accumulator.weight
+        for name in statistics:
+            results[(band, name)] = accumulator.statistic(name)
+    return results
+
+
+def opencv_zonal_statistics(indicator, pixel_values, geometries):
+    """
+    Compute the mean and maximum of every polygon filling one full-extent mask per polygon.
+
+    This is the original per-polygon implementation, kept to reproduce previous results.
+
+    Args:
+        indicator: Open rasterio dataset
+        pixel_values: Band values read from the dataset
+        geometries: Array of shapely geometries, in the raster CRS
+
+    Returns:
+        Dictionary with the (1, 'mean') and (1, 'max') arrays, one value per geometry
+    """
+    # Bring values from degrees to Cartesian plane
+    min_lat, max_lon, max_lat, min_lon = indicator.bounds
+    min_x, min_y = indicator.index(min_lat, min_lon)
+    max_x, max_y = indicator.index(max_lat, max_lon)
+    width, height = int(max_x - min_x), int(max_y - min_y)
+
+    num_polygons = len(geometries)
+    mean = np.full(num_polygons, -1.0)
+    max_value = np.full(num_polygons, -1.0)
+
+    # Create a progress bar with the number of polygons and display the elapsed time next to the value
+    with Bar(f'Processing {num_polygons} polygons', max=num_polygons) as bar:
+        for idx, geometry in enumerate(geometries):
+            # Transform multi-polygon into polygon
+            geometry = convert_multi_to_single_polygon(geometry)
+
+            polygons = np.zeros((width, height), dtype=np.uint8)
+            pts = np.array([indicator.index(point[0], point[1]) for point in geometry.exterior.coords[:]], np.int32)[:, ::-1]
+            pts = pts - np.array([min_y, min_x])
+
+            cv2.fillPoly(polygons, [pts], 1)  # mask
+
+            x, y = np.where(polygons == 1)
+            values = pixel_values[x, y]
+            # Remove all negative values from the value list
+            values = values[values >= 0]
+
+            # Check if the value list is not empty
+            if len(values) > 0:
+                max_value[idx] = np.nanmax(values)
+                # Calculate the arithmetic mean
+                mean[idx] = np.mean(values)
+
+            # Update the progress bar
+            bar.next()
+
+    return {(1, 'mean'): mean, (1, 'max'): max_value}
+
+
+def _opencv_engine(indicator, geometries, statistics=('mean', 'max'), **options):
+    values = opencv_zonal_statistics(indicator, indicator.read(1), geometries)
+    return {(1, statistic): values[(1, statistic)] for statistic in statistics}
+
+
+# Zonal statistics backends selectable with merge_rasters_mesh.py --engine. Every backend takes the
+# open dataset, the geometries in the raster CRS and keyword options, and returns {(band, statistic): values}
+ENGINES = {
+    'label': label_zonal_statistics,
+    'opencv': _opencv_engine,
+    'numba': numba_zonal_statistics,
+}
+
+
+def zonal_statistics(indicator, geometries, engine='label', **options):
+    """
+    Compute the statistics of every polygon with one of the ENGINES.
+
+    Args:
+        indicator: Open rasterio dataset
+        geometries: Array of shapely geometries, in the raster CRS
+        engine: Name of the backend
+        **options: Options of the backend (statistics, bands, memory_budget, ...)
+
+    Returns:
+        Dictionary with one array of values per geometry for each (band, statistic)
+    """
+    return ENGINES[engine](indicator, geometries, **options)
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import shapely
+from affine import Affine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from zonal_statistics import coverage_membership  # noqa: E402
+
+SHAPE = (12, 14)
+TRANSFORM = Affine(1.0, 0.0, 0.0, 0.0, -1.0, SHAPE[0])
+
+
+def expected_weights(geometries):
+    """Covered fraction of every (pixel, polygon) pair, from the shapely intersection areas."""
+    height, width = SHAPE
+    rows, cols = np.divmod(np.arange(height * width), width)
+    x, y = TRANSFORM * (cols, rows)
+    pixel_boxes = shapely.box(x, y + TRANSFORM.e, x + TRANSFORM.a, y)
+    weights = {}
+    for polygon_id, geometry in enumerate(geometries):
+        areas = shapely.area(shapely.intersection(pixel_boxes, geometry)) / abs(TRANSFORM.a * TRANSFORM.e)
+        for pixel in np.flatnonzero(areas > 1e-9):
+            weights[(int(pixel), polygon_id)] = areas[pixel]
+    return weights
+
+
+def assert_coverage(geometries):
+    geometries = np.asarray(geometries, dtype=object)
+    pixels, ids, weights = coverage_membership(geometries, TRANSFORM, SHAPE)
+    got = dict(zip(zip(pixels.tolist(), ids.tolist()), weights))
+    expected = expected_weights(geometries)
+    assert set(got) == set(expected)
+    for key, weight in expected.items():
+        assert got[key] == pytest.approx(weight, abs=1e-9), key
+
+
+@pytest.mark.parametrize('geometry', [
+    shapely.box(0.5, 5.5, 3.5, 8.5),
+    shapely.box(2.0, 1.0, 6.0, 4.0),
+    shapely.box(0.2, 0.2, 0.8, 0.9),
+    shapely.box(-2.5, 3.25, 2.5, 14.0),
+    shapely.Polygon([(1.5, 1.5), (9.5, 1.5), (9.5, 9.5), (5.5, 9.5), (5.5, 5.25), (1.5, 5.25)]),
+])
+def test_axis_aligned_polygons(geometry):
+    assert_coverage([geometry])
+
+
+@pytest.mark.parametrize('angle', [15, 30, 45, 77])
+def test_rotated_polygons(angle):
+    geometry = shapely.affinity.rotate(shapely.box(3.3, 2.6, 9.1, 8.4), angle)
+    assert_coverage([geometry])
+
+
+def test_polygon_with_hole():
+    geometry = shapely.box(1.5, 1.5, 10.5, 10.5).difference(shapely.box(4.0, 3.5, 7.5, 8.2))
+    assert_coverage([geometry])
+
+
+def test_adjacent_grid_cells():
+    cells = [shapely.box(x, y, x + 2.5, y + 2.5) for x in np.arange(0.5, 12, 2.5) for y in np.arange(0.5, 10, 2.5)]
+    assert_coverage(cells)
+
+
+def test_polygon_covering_the_whole_window():
+    pixels, ids, weights = coverage_membership(np.array([shapely.box(-10, -10, 20, 20)], dtype=object),
+                                               TRANSFORM, SHAPE)
+    assert len(pixels) == SHAPE[0] * SHAPE[1]
+    assert (ids == 0).all() and (weights == 1.0).all()
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from utilities import grouped_weighted_average  # noqa: E402
+
+
+def lambda_weighted_average(intersection, key):
+    """Weighted average computed like merge_shapefiles_mesh.py did before the grouped sums."""
+    return intersection.groupby(key).apply(lambda x: sum(x['CL_ORIG'] * x['weight']) / sum(x['weight']))
+
+
+def assert_matches_lambda(intersection, key='id'):
+    expected = lambda_weighted_average(intersection[[key, 'CL_ORIG', 'weight']], key)
+    result = grouped_weighted_average(intersection[key], intersection['CL_ORIG'], intersection['weight'])
+    pd.testing.assert_series_equal(result, expected, check_names=False, check_index_type=False, rtol=1e-12)
+
+
+def test_random_groups():
+    rng = np.random.default_rng(3)
+    size = 5000
+    intersection = pd.DataFrame({'id': rng.integers(0, 300, size), 'CL_ORIG': rng.normal(0.5, 0.2, size),
+                                 'weight': rng.uniform(0.0, 1.0, size)})
+    assert_matches_lambda(intersection)
+
+
+def test_string_keys():
+    intersection = pd.DataFrame({'id': ['b', 'a', 'b', 'c', 'a'], 'CL_ORIG': [1.0, 2.0, 3.0, 4.0, 5.0],
+                                 'weight': [0.5, 1.0, 1.5, 2.0, 0.25]})
+    assert_matches_lambda(intersection)
+
+
+def test_nan_values_make_their_group_nan():
+    intersection = pd.DataFrame({'id': [1, 1, 2, 2, 3], 'CL_ORIG': [0.2, np.nan, 0.4, 0.6, np.nan],
+                                 'weight': [1.0, 2.0, 0.5, 0.5, 3.0]})
+    assert_matches_lambda(intersection)
+    result = grouped_weighted_average(intersection['id'], intersection['CL_ORIG'], intersection['weight'])
+    assert np.isnan(result[1]) and np.isnan(result[3]) and result[2] == pytest.approx(0.5)
+
+
+def test_zero_weight_groups_are_nan():
+    intersection = pd.DataFrame({'id': [1, 1, 2, 3], 'CL_ORIG': [0.2, 0.8, 0.4, 0.9],
+                                 'weight': [0.0, 0.0, 1.0, 0.0]})
+    # The Python division of the lambda fails on the first group with zero total weight
+    with pytest.raises(ZeroDivisionError):
+        lambda_weighted_average(intersection, 'id')
+    assert_matches_lambda(intersection[intersection['id'] == 2])
+    result = grouped_weighted_average(intersection['id'], intersection['CL_ORIG'], intersection['weight'])
+    assert np.isnan(result[1]) and np.isnan(result[3]) and result[2] == pytest.approx(0.4)
+
+
+def test_rows_without_key_are_ignored():
+    intersection = pd.DataFrame({'id': [1.0, np.nan, 2.0, np.nan, 1.0], 'CL_ORIG': [0.2, 0.9, 0.4, 0.7, 0.6],
+                                 'weight': [1.0, 5.0, 1.0, 2.0, 3.0]})
+    assert_matches_lambda(intersection)
+    result = grouped_weighted_average(intersection['id'], intersection['CL_ORIG'], intersection['weight'])
+    assert list(result.index) == [1.0, 2.0] and result[1.0] == pytest.approx(0.5)
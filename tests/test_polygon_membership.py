@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+import shapely
+from affine import Affine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from zonal_statistics import polygon_membership  # noqa: E402
+
+SHAPE = (8, 8)
+TRANSFORM = Affine(1.0, 0.0, 0.0, 0.0, -1.0, SHAPE[0])
+
+
+def columns_of(pixels, ids, polygon_id):
+    return sorted(set((pixels[ids == polygon_id] % SHAPE[1]).tolist()))
+
+
+def test_all_touched_adjacent_polygons_share_border_pixels():
+    geometries = np.array([shapely.box(0.2, 2.0, 3.5, 5.0), shapely.box(3.5, 2.0, 6.0, 5.0)], dtype=object)
+    pixels, ids = polygon_membership(geometries, TRANSFORM, SHAPE, all_touched=True)
+    assert columns_of(pixels, ids, 0) == [0, 1, 2, 3]
+    assert columns_of(pixels, ids, 1) == [3, 4, 5]
+
+
+def test_centre_rule_adjacent_polygons_do_not_share_pixels():
+    geometries = np.array([shapely.box(0.2, 2.0, 3.5, 5.0), shapely.box(3.5, 2.0, 6.0, 5.0)], dtype=object)
+    pixels, ids = polygon_membership(geometries, TRANSFORM, SHAPE)
+    assert len(np.unique(pixels)) == len(pixels)
+    assert columns_of(pixels, ids, 0) == [0, 1, 2] or columns_of(pixels, ids, 1) == [4, 5]
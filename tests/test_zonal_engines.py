@@ -0,0 +1,60 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import shapely
+from affine import Affine
+from rasterio.io import MemoryFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from zonal_statistics import SCANLINE_STATISTICS, label_zonal_statistics, numba_zonal_statistics  # noqa: E402
+
+pytest.importorskip('numba')
+
+SHAPE = (120, 150)
+TRANSFORM = Affine(10.0, 0.0, 5000.0, 0.0, -10.0, 9000.0)
+
+
+def geometries():
+    """Rotated polygons, polygons with holes, a multipolygon and overlapping polygons, in raster CRS units."""
+    left, top = TRANSFORM.c, TRANSFORM.f
+    rotated = [shapely.affinity.rotate(shapely.box(left + 103, top - 407, left + 391, top - 213), angle)
+               for angle in (17, 45, 71)]
+    holed = shapely.box(left + 513, top - 903, left + 1087, top - 461).difference(
+        shapely.box(left + 641, top - 787, left + 907, top - 577))
+    star = shapely.Polygon([(left + 1250 + r * np.cos(a), top - 300 + r * np.sin(a))
+                            for a, r in zip(np.linspace(0, 2 * np.pi, 11)[:-1], [243, 97] * 5)])
+    multi = shapely.MultiPolygon([shapely.box(left + 33, top - 1147, left + 287, top - 1011),
+                                  shapely.affinity.rotate(shapely.box(left + 1191, top - 1113, left + 1427, top - 871), 33)])
+    overlapping = shapely.box(left + 301, top - 611, left + 707, top - 303)
+    outside = shapely.box(left - 500, top + 100, left - 200, top + 300)
+    return np.array(rotated + [holed, star, multi, overlapping, outside], dtype=object)
+
+
+@pytest.fixture(scope='module')
+def indicator():
+    rng = np.random.default_rng(7)
+    values = rng.normal(5.0, 3.0, size=(2,) + SHAPE).astype(np.float32)
+    with MemoryFile() as memory_file:
+        with memory_file.open(driver='GTiff', width=SHAPE[1], height=SHAPE[0], count=2, dtype='float32',
+                              crs='EPSG:5880', transform=TRANSFORM, tiled=True, blockxsize=32,
+                              blockysize=32) as dataset:
+            # Negative values are missing data, since the raster declares no nodata
+            dataset.write(values)
+        with memory_file.open() as dataset:
+            yield dataset
+
+
+@pytest.mark.parametrize('memory_budget', [None, 0.05])
+def test_numba_engine_matches_label_engine(indicator, memory_budget):
+    statistics = list(SCANLINE_STATISTICS)
+    expected = label_zonal_statistics(indicator, geometries(), statistics=statistics, bands=(1, 2))
+    result = numba_zonal_statistics(indicator, geometries(), memory_budget=memory_budget, statistics=statistics,
+                                    bands=(1, 2))
+    assert set(result) == set(expected)
+    # Every polygon but the one outside the raster has pixels
+    assert (expected[(1, 'count')][:-1] > 0).all() and expected[(1, 'count')][-1] == 0
+    for key in expected:
+        np.testing.assert_allclose(result[key], expected[key], rtol=1e-10, atol=1e-10, err_msg=str(key))